@@ -62,9 +62,15 @@ def getclass(table):
     return db.cls[table]()
 
 
-def getData(obj):
+def getData(obj, postdata=None, partial=False):
+    """
+    Decode posted data to database format
+    If partial is True, only a subset of the columns are expected, as
+    sent by an update of changed columns
+    """
     decodeddata = {}
-    postdata = request.form()
+    if postdata is None:
+        postdata = request.form()
     for key in obj._columns:
         if key in postdata.keys():
             column = obj._columns[key]
@@ -81,10 +87,12 @@ def getData(obj):
                 data = basium_driver_json.FloatCol.toPython(data)
             elif isinstance(column, basium_model.IntegerCol):
                 data = basium_driver_json.IntegerCol.toPython(data)
+            elif isinstance(column, basium_model.ReferenceCol):
+                data = basium_driver_json.ReferenceCol.toPython(data)
             elif isinstance(column, basium_model.VarcharCol):
                 data = basium_driver_json.VarcharCol.toPython(data)
             decodeddata[key] = column.toSql(data)        # encode to database specific format
-        else:
+        elif not partial:
             log.warning("Warning, missing key/column %s" % key)
     return decodeddata
 
@@ -120,12 +128,7 @@ def handleGetFilter(request, response, table):
     
     resp = bc.Response()
     try:
-        resp.data = []
-        for row in db.driver.select(dbquery):  # we call driver directly for efficiency reason
-            tmp = {}
-            for colname in obj._iterName():
-                tmp[colname] = row[colname]
-            resp.data.append(tmp)
+        resp.data = db.load(dbquery, rows='dict')  # plain rows, no objects are created
     except db.Error as e:
         msg = "Could not load objects from table '%s'. %s" % (obj._table, e)
         log.debug(msg)
@@ -136,6 +139,29 @@ def handleGetFilter(request, response, table):
     writejson(resp)
 
 
+@app.route("/<table>/exists/")
+def handleGetExists(request, response, table):
+    """
+    Check if there is any row matching a query
+    Returns True or False
+    """
+    obj = getclass(table)
+    dbquery = db.query(obj)
+    dbquery.decode(request.query_string)
+    log.debug("Check if any row in table '%s' matches query %s" % (obj._table, dbquery.toSql()))
+
+    resp = bc.Response()
+    try:
+        resp.data = db.driver.exists(dbquery.limitOne(exists=True))  # we call driver directly for efficiency reason
+    except db.Error as e:
+        msg = "Could not query table '%s'. %s" % (obj._table, e)
+        log.debug(msg)
+        response.setError(1, msg)
+        response.status_code = '404 ' + msg
+        return
+    writejson(resp)
+
+
 @app.route("/<table>/<_id:int:o>")
 def handleGet(request, response, table, _id=None):
     obj = getclass(table)
@@ -150,12 +176,7 @@ def handleGet(request, response, table, _id=None):
     
     resp = bc.Response()
     try:
-        resp.data = []
-        for row in db.driver.select(dbquery):  # we call driver directly for efficiency reason
-            tmp = {}
-            for colname in obj._iterName():
-                tmp[colname] = row[colname]
-            resp.data.append(tmp)
+        resp.data = db.load(dbquery, rows='dict')  # plain rows, no objects are created
     except db.Error as e:
         msg = "Could not load objects from table '%s'. %s" % (obj._table, e)
         log.debug(msg)
@@ -172,6 +193,30 @@ def handleGet(request, response, table, _id=None):
     writejson(resp)
 
 
+@app.route("/<table>/_batch", methods=["POST"])
+def handlePostBatch(request, response, table):
+    """
+    Insert multiple rows, sent as a JSON list in the 'rows' form field
+    Returns a list with the _id of the new rows
+    """
+    obj = getclass(table)
+    log.debug("Insert multiple rows in table '%s'" % (obj._table))
+    resp = bc.Response()
+    try:
+        rows = json.loads(request.form('rows'))
+    except (TypeError, ValueError):
+        raise WsgiError("Incorrect 'rows' data in batch insert", 400)
+    postdata = []
+    for row in rows:
+        postdata.append(getData(obj, row))
+    try:
+        resp.data = db.driver.insertMany(obj._table, postdata) # we call driver direct for efficiency reason
+    except db.Error as e:
+        resp.errno = e.errno
+        resp.errmsg = e.errmsg
+    writejson(resp)
+
+
 @app.route("/<table>", methods=["POST"])
 def handlePost(request, response, table):
     obj = getclass(table)
@@ -190,7 +235,7 @@ def handlePost(request, response, table):
 def handlePut(request, response, table, _id):
     obj = getclass(table)
     log.debug("Update one row in table '%s'" % (obj._table))
-    putdata = getData(obj)
+    putdata = getData(obj, partial=True)
     putdata['_id'] = _id
     resp = bc.Response()
     try:
@@ -59,14 +59,36 @@ Error = bc.Error
 class DbConf:
     """
     Information to the selected database driver, how to connect to database
+
+    serverCursor: if True, iterLoad() keeps the result on the database
+                  server (psql and mysql), fetching batchsize rows at a time
+    batchsize:    default number of rows fetched in each round trip by iterLoad()
+
+    Connection pool, mysql and psql:
+    poolMin:      number of connections kept open when idle
+    poolMax:      max number of open connections
+    poolTimeout:  seconds to wait for a free connection, sqlite waits this long for a locked database
+    poolIdle:     seconds before an idle connection is closed
+    poolLifetime: seconds before a connection is closed and replaced
+    poolCheck:    a connection unused for this many seconds is checked before use
     """
-    def __init__(self, host=None, port=None, username=None, password=None, database=None, debugSQL=False, log=None):
+    def __init__(self, host=None, port=None, username=None, password=None, database=None, debugSQL=False, log=None,
+                 serverCursor=False, batchsize=1000, poolMin=1, poolMax=10, poolTimeout=30,
+                 poolIdle=300, poolLifetime=3600, poolCheck=10):
         self.host = host
         self.port = None
         self.username = username
         self.password = password
         self.database = database
         self.debugSQL = debugSQL
+        self.serverCursor = serverCursor
+        self.batchsize = batchsize
+        self.poolMin = poolMin
+        self.poolMax = poolMax
+        self.poolTimeout = poolTimeout
+        self.poolIdle = poolIdle
+        self.poolLifetime = poolLifetime
+        self.poolCheck = poolCheck
 
 
 class Basium(basium_orm.BasiumOrm):
@@ -87,6 +109,8 @@ class Basium(basium_orm.BasiumOrm):
         self.dbconf = dbconf
 
         self.cls = {}
+        self.session = None              # identity map, see startSession()
+        self.cache = None                # query result cache, see setCache()
         self.drivermodule = None
         self.Response = bc.Response      # for convenience in dynamic pages
         self.Error = bc.Error            # for convenience in dynamic pages
@@ -95,6 +119,13 @@ class Basium(basium_orm.BasiumOrm):
     def setDebug(self, debugLevel):
         self.debug = debugLevel
 
+    def setCache(self, cache):
+        """
+        Use a result cache for load() and count(), for example
+        a basium_orm.QueryCache(). None disables the cache
+        """
+        self.cache = cache
+
     def addClass(self, cls):
         if not isinstance(cls, type):
             self.log.error('addClass() called with an instance of an object')
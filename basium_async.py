@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012-2013, Anders Lowinger, Abundo AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+asyncio interface for basium
+
+The database drivers are blocking, so all calls are done in a bounded
+thread pool. Each worker thread has its own Basium instance, and with
+that its own database connection, so a small number of connections are
+shared by all tasks
+
+Usage:
+    db = basium_async.AsyncBasium(driver='psql', dbconf=dbconf, workers=4)
+    db.addClass(MyClass)
+    await db.start()
+    objs = await db.load(db.query().filter(obj.q.name, '=', 'x'))
+    async for obj in db.iterLoad(query):
+        ...
+    db.close()
+"""
+
+import asyncio
+import functools
+import threading
+import concurrent.futures
+
+import basium
+import basium_common as bc
+import basium_orm
+
+
+class AsyncBasium:
+    """
+    Main class for asyncio usage, the methods are coroutines that
+    correspond to the methods in Basium, keyword arguments are passed on
+    """
+    def __init__(self, logger=None, driver=None, checkTables=True, dbconf=None, workers=4):
+        self.logger = logger
+        if logger:
+            self.log = logger
+        else:
+            self.log = basium.log
+        self.drivername = driver
+        self.checkTables = checkTables
+        self.dbconf = dbconf
+        self.workers = workers
+
+        self.cls = []
+        self.executor = None
+        self.local = threading.local()     # Basium instance for each worker thread
+        self.lock = threading.Lock()
+        self.started = False
+        self.Error = bc.Error
+
+    def addClass(self, cls):
+        """Register a class, must be done before start()"""
+        if self.executor is not None:
+            self.log.error('AsyncBasium.addClass() called after start()')
+            return False
+        self.cls.append(cls)
+        return True
+
+    def _db(self):
+        """
+        Return the Basium instance for the current worker thread,
+        created the first time. Only the first one checks the tables
+        """
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            return db
+        with self.lock:
+            checkTables = self.checkTables and not self.started
+            db = basium.Basium(logger=self.logger, driver=self.drivername, checkTables=checkTables, dbconf=self.dbconf)
+            for cls in self.cls:
+                db.addClass(cls)
+            if not db.start():
+                raise bc.Error(1, "Cannot start database driver %s" % self.drivername)
+            self.started = True
+        self.local.db = db
+        return db
+
+    def _call(self, method, *args, **kwargs):
+        return getattr(self._db(), method)(*args, **kwargs)
+
+    async def _run(self, method, *args, **kwargs):
+        """Run a Basium method in the thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(self._call, method, *args, **kwargs))
+
+    async def start(self):
+        """Start the thread pool and connect the first worker to the database"""
+        if self.executor is not None:
+            self.log.error("AsyncBasium.start() already called")
+            return None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            await self._run('isDatabase', self.dbconf.database)
+        except bc.Error as e:
+            self.log.error(str(e))
+            return None
+        return True
+
+    def close(self):
+        """Stop the thread pool, waits for running calls to finish"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def query(self, obj=None):
+        """
+        Create and return a query object, use the coroutines in
+        this class to run it
+        """
+        return basium_orm.Query(obj, log=self.log)
+
+    async def count(self, query, **kwargs):
+        return await self._run('count', query, **kwargs)
+
+    async def load(self, query, **kwargs):
+        return await self._run('load', query, **kwargs)
+
+    async def loadColumns(self, query, batchsize=None, **kwargs):
+        return await self._run('loadColumns', query, batchsize, **kwargs)
+
+    async def loadMany(self, cls, ids, **kwargs):
+        return await self._run('loadMany', cls, ids, **kwargs)
+
+    async def first(self, query, **kwargs):
+        return await self._run('first', query, **kwargs)
+
+    async def get(self, query, **kwargs):
+        return await self._run('get', query, **kwargs)
+
+    async def exists(self, query, **kwargs):
+        return await self._run('exists', query, **kwargs)
+
+    async def store(self, obj, **kwargs):
+        return await self._run('store', obj, **kwargs)
+
+    async def storeMany(self, objs, chunksize=500, **kwargs):
+        return await self._run('storeMany', objs, chunksize, **kwargs)
+
+    async def delete(self, query, **kwargs):
+        return await self._run('delete', query, **kwargs)
+
+    async def iterLoad(self, query, batchsize=None, prefetch=2, **kwargs):
+        """
+        Async generator, yields one object at a time, for use with async for
+        Other keyword arguments, like rows=, are passed to Basium.iterLoad()
+
+        One worker thread reads the result with Basium.iterLoad(), so the
+        cursor stays on the same connection, and hands over batchsize
+        rows at a time. At most prefetch batches are read in advance.
+        The worker is busy until all rows are read or the iteration
+        is stopped
+        """
+        if batchsize is None:
+            batchsize = 1000
+            if self.dbconf is not None:
+                batchsize = self.dbconf.batchsize
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            # stop is checked after each row and each put, so after the
+            # consumer has stopped at most one more item is put in the queue
+            try:
+                batch = []
+                for obj in self._db().iterLoad(query, batchsize, **kwargs):
+                    if stop.is_set():
+                        return
+                    batch.append(obj)
+                    if len(batch) >= batchsize:
+                        put(('data', batch))
+                        batch = []
+                        if stop.is_set():
+                            return
+                put(('data', batch))
+                if stop.is_set():
+                    return
+                put(('end', None))
+            except Exception as e:
+                if not stop.is_set():
+                    put(('error', e))
+
+        future = loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                kind, data = await queue.get()
+                if kind == 'end':
+                    break
+                if kind == 'error':
+                    raise data
+                for obj in data:
+                    yield obj
+        finally:
+            # release the worker if the iteration is stopped early, the
+            # queue is emptied so a blocked put() can finish
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()
+            await future
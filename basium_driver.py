@@ -31,8 +31,12 @@
 Basium base class for all driver implementations
 """
 
+import time
 import datetime
 import decimal
+import functools
+import threading
+import collections
 
 import basium_common as bc
 
@@ -48,6 +52,8 @@ import basium_common as bc
 
 class Column:
 
+    nativeType = False  # True if the database module already returns the python type, toPython() is not needed
+
     def toPython(self, value):
         return value
 
@@ -193,17 +199,295 @@ class VarcharCol(Column):
             return value
 
 
+class ReferenceCol(IntegerCol):
+    """
+    Stores the _id of a row in another table
+    """
+    pass
+
+
+class ListCursor:
+    """
+    Minimal cursor over a list of rows that has already been fetched,
+    used by drivers that does not have a real database cursor
+    rows is a list of tuples, names the column name for each position
+    """
+    def __init__(self, rows=None, names=None):
+        if rows is None:
+            rows = []
+        if names is None:
+            names = []
+        self.rows = rows
+        self.pos = 0
+        self.description = [(name, None, None, None, None, None, None) for name in names]
+
+    def __iter__(self):
+        while self.pos < len(self.rows):
+            self.pos += 1
+            yield self.rows[self.pos - 1]
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rows
+
+
+class SqlCache:
+    """
+    Thread safe cache for compiled SQL statements, keyed on the query shape
+    Also used for the hydrate functions in the ORM.
+    At most maxsize entries are kept, the least recently used is
+    evicted first
+    """
+    def __init__(self, maxsize=500):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                sql = self.entries[key]
+            except KeyError:
+                return default
+            self.entries.move_to_end(key)
+            return sql
+
+    def __getitem__(self, key):
+        sql = self.get(key)
+        if sql is None:
+            raise KeyError(key)
+        return sql
+
+    def __setitem__(self, key, sql):
+        with self.lock:
+            self.entries[key] = sql
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of database connections
+
+    connect() creates a new connection, close(conn) closes one and
+    ping(conn) returns False if the connection is not usable anymore
+
+    At most maxsize connections are open, checkout() waits up to timeout
+    seconds for a free connection. Connections are created when needed,
+    minsize connections are kept open even if they are idle longer than
+    idle seconds. A connection is closed when it is older than lifetime
+    seconds, and checked with ping() if it has been unused for more than
+    check seconds
+    """
+
+    def __init__(self, connect, close=None, ping=None, minsize=1, maxsize=10,
+                 timeout=30, idle=300, lifetime=3600, check=10):
+        self.connect = connect
+        self.close = close
+        self.ping = ping
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = idle
+        self.lifetime = lifetime
+        self.check = check
+
+        self.cond = threading.Condition()
+        self.free = []          # idle connections, (conn, created, lastused)
+        self.inuse = {}         # id(conn) -> created
+        self.size = 0           # open connections, including ones being created
+        self.checkouts = 0
+        self.waits = 0
+        self.waittime = 0.0
+        self.maxwait = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.closed = 0
+
+    def _close(self, conns):
+        """Close connections, called without holding the lock"""
+        for conn in conns:
+            if self.close is not None:
+                try:
+                    self.close(conn)
+                except Exception:
+                    pass
+
+    def _expire(self, now):
+        """Remove old and unneeded idle connections, returns them so they can be closed"""
+        expired = []
+        keep = []
+        for conn, created, lastused in self.free:
+            if now - created > self.lifetime or \
+                    (now - lastused > self.idle and self.size - len(expired) > self.minsize):
+                expired.append(conn)
+            else:
+                keep.append((conn, created, lastused))
+        self.free = keep
+        self.size -= len(expired)
+        self.closed += len(expired)
+        return expired
+
+    def checkout(self):
+        """
+        Get a connection from the pool, the caller must give it back
+        with checkin(). Raises bc.Error if no connection is free in time
+        """
+        start = time.monotonic()
+        waited = False
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    expired = self._expire(now)
+                    if self.free:
+                        conn, created, lastused = self.free.pop()    # last used, most likely alive
+                        break
+                    if self.size < self.maxsize:
+                        self.size += 1
+                        conn = None
+                        break
+                    remaining = start + self.timeout - now
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise bc.Error(1, 'Timeout waiting for a database connection, %d in use' % len(self.inuse))
+                    waited = True
+                    self.cond.wait(remaining)
+                wait = now - start
+                self.checkouts += 1
+                if waited:
+                    self.waits += 1
+                self.waittime += wait
+                self.maxwait = max(self.maxwait, wait)
+            self._close(expired)
+
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self.cond:
+                        self.size -= 1
+                        self.cond.notify()
+                    raise
+                created = time.monotonic()
+                with self.cond:
+                    self.created += 1
+            elif self.ping is not None and now - lastused > self.check and not self.ping(conn):
+                with self.cond:
+                    self.size -= 1
+                    self.closed += 1
+                self._close([conn])
+                continue
+            with self.cond:
+                self.inuse[id(conn)] = created
+            return conn
+
+    def checkin(self, conn, broken=False):
+        """
+        Return a connection to the pool
+        If broken is True the connection is closed instead
+        """
+        now = time.monotonic()
+        with self.cond:
+            created = self.inuse.pop(id(conn), now)
+            if broken or now - created > self.lifetime:
+                self.size -= 1
+                self.closed += 1
+                conn = [conn]
+            else:
+                self.free.append((conn, created, now))
+                conn = []
+            self.cond.notify()
+        self._close(conn)
+
+    def closeAll(self):
+        """Close all idle connections"""
+        with self.cond:
+            conns = [conn for conn, created, lastused in self.free]
+            self.free = []
+            self.size -= len(conns)
+            self.closed += len(conns)
+        self._close(conns)
+
+    def stats(self):
+        """Return counters, to check the pool size and wait times"""
+        with self.cond:
+            return {"size": self.size, "idle": len(self.free), "inuse": len(self.inuse),
+                    "maxsize": self.maxsize, "utilization": len(self.inuse) / self.maxsize,
+                    "checkouts": self.checkouts, "waits": self.waits, "waittime": self.waittime,
+                    "maxwait": self.maxwait, "timeouts": self.timeouts,
+                    "created": self.created, "closed": self.closed}
+
+
+def pooled(method):
+    """
+    Decorator for PooledDriver methods
+    The connection used by the calling thread is returned to the pool
+    when the outermost driver call is done, unless a transaction or a
+    streaming cursor still needs it
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        local = self.local
+        local.calls += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            local.calls -= 1
+            if local.calls == 0:
+                self.release()
+    return wrapper
+
+
+class DriverLocal(threading.local):
+    """Per thread state for a PooledDriver"""
+    def __init__(self):
+        self.dbconnection = None
+        self.cursor = None
+        self.txdepth = 0
+        self.calls = 0
+        self.streams = []
+
+
 class BaseDriver:
     """
     Driver base class, Mostly stubs, needs to be overridden
     by the specific driver
     """
+    maxParams = None    # max number of values in one query, None is no limit
+    txdepth = 0         # number of nested transactions
+
     def connect(self):
         raise bc.Error(1, 'Not implemented')
 
     def execute(self, method=None, url=None, data=None, decode=False):
         raise bc.Error(1, 'Not implemented')
 
+    def begin(self):
+        raise bc.Error(1, 'Not implemented')
+
+    def commit(self):
+        raise bc.Error(1, 'Not implemented')
+
+    def rollback(self):
+        raise bc.Error(1, 'Not implemented')
+
     def isDatabase(self, dbName):
         return True
 
@@ -222,14 +506,128 @@ class BaseDriver:
     def count(self, query):
         raise bc.Error(1, 'Not implemented')
 
-    def select(self, query):
+    def select(self, query, stream=False):
+        raise bc.Error(1, "Not implemented")
+
+    def exists(self, query):
         raise bc.Error(1, "Not implemented")
 
+    def fetchIter(self, cursor, batchsize):
+        """
+        Fetch rows from a cursor returned by select(), batchsize rows at a time
+        Generator, yields one row at a time
+        """
+        while True:
+            rows = cursor.fetchmany(batchsize)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
     def insert(self, table, values):
         raise bc.Error(1, 'Not implemented')
 
+    def insertMany(self, table, rows):
+        """
+        Insert multiple rows in the table
+        Generic version, inserts one row at a time
+        Returns list with the _id of the new rows
+        """
+        ids = []
+        for values in rows:
+            ids.append(self.insert(table, values))
+        return ids
+
     def update(self, table, values):
         raise bc.Error(1, 'Not implemented')
 
     def delete(self, query):
         raise bc.Error(1, 'Not implemented')
+
+    def poolStats(self):
+        """Statistics from the connection pool, None if the driver has no pool"""
+        return None
+
+
+class PooledDriver(BaseDriver):
+    """
+    Base class for drivers that use a ConnectionPool
+
+    Each thread checks out its own connection, so dbconnection, cursor
+    and txdepth are per thread. The driver implements newConnection(),
+    newCursor(conn), pingConnection(conn), resetConnection(conn) and
+    closeConnection(conn)
+    """
+
+    def initPool(self):
+        self.local = DriverLocal()
+        self.pool = ConnectionPool(self.newConnection, close=self.closeConnection, ping=self.pingConnection,
+                                   minsize=self.dbconf.poolMin, maxsize=self.dbconf.poolMax,
+                                   timeout=self.dbconf.poolTimeout, idle=self.dbconf.poolIdle,
+                                   lifetime=self.dbconf.poolLifetime, check=self.dbconf.poolCheck)
+
+    @property
+    def dbconnection(self):
+        return self.local.dbconnection
+
+    @property
+    def cursor(self):
+        return self.local.cursor
+
+    @property
+    def txdepth(self):
+        return self.local.txdepth
+
+    @txdepth.setter
+    def txdepth(self, value):
+        self.local.txdepth = value
+
+    def connect(self):
+        """Check out a connection for the calling thread"""
+        conn = self.pool.checkout()
+        try:
+            self.local.cursor = self.newCursor(conn)
+        except bc.Error:
+            self.pool.checkin(conn, broken=True)
+            raise
+        self.local.dbconnection = conn
+
+    def disconnect(self):
+        """Close the connection of the calling thread, it is not usable anymore"""
+        if self.local.dbconnection is not None:
+            self.pool.checkin(self.local.dbconnection, broken=True)
+        self.local.dbconnection = None
+        self.local.cursor = None
+        self.local.streams = []
+        self.tables = None
+
+    def release(self):
+        """
+        Return the connection of the calling thread to the pool, if
+        no transaction or streaming cursor is using it
+        """
+        local = self.local
+        if local.dbconnection is None or local.txdepth > 0 or local.streams:
+            return
+        conn = local.dbconnection
+        local.dbconnection = None
+        local.cursor = None
+        try:
+            self.resetConnection(conn)
+        except bc.Error:
+            self.pool.checkin(conn, broken=True)
+            return
+        self.pool.checkin(conn)
+
+    def closeStream(self, cursor):
+        """A streaming cursor is done, the connection can be released"""
+        if cursor in self.local.streams:
+            self.local.streams.remove(cursor)
+            if self.local.calls == 0:
+                self.release()
+
+    def resetConnection(self, conn):
+        pass
+
+    def poolStats(self):
+        return self.pool.stats()
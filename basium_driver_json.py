@@ -89,7 +89,7 @@ class DateCol(basium_driver.DateCol):
         if isinstance(value, datetime.datetime):
             value = value.date()
         if isinstance(value, str):
-            value = datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+            value = datetime.date.fromisoformat(value[:10])
         return value
 
     def toSql(self, value):
@@ -108,7 +108,7 @@ class DateTimeCol(basium_driver.DateTimeCol):
         if value == "NULL":
             return None
         if isinstance(value, str):
-            value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+            value = datetime.datetime.fromisoformat(value)
         return value
 
     def toSql(self, value):
@@ -198,6 +198,18 @@ class VarcharCol(basium_driver.VarcharCol):
         return value
 
 
+class ReferenceCol(IntegerCol):
+    """
+    Stores the _id of a row in another table
+    """
+
+    @classmethod
+    def toPython(self, value):
+        if value is None or value == "NULL":
+            return None
+        return int(value)
+
+
 class RequestWithMethod(urllib.request.Request):
     """
     Helper class, to implement HTTP GET, POST, PUT, DELETE
@@ -216,6 +228,7 @@ class BasiumDriver(basium_driver.BaseDriver):
         self.dbconf = dbconf
 
         self.uri = '%s/api' % (self.dbconf.host)
+        self.maxParams = 200    # values are sent in the URL, keep it short
 
     def connect(self):
         """
@@ -266,6 +279,21 @@ class BasiumDriver(basium_driver.BaseDriver):
 
         return respdata, resp
 
+    def begin(self):
+        """
+        Transactions are not supported by the JSON API, each request is
+        committed by the server. Only the nesting is tracked
+        """
+        self.txdepth += 1
+
+    def commit(self):
+        self.txdepth -= 1
+
+    def rollback(self):
+        """Nothing can be rolled back, the changes are already committed"""
+        self.txdepth -= 1
+        self.log.warning("JSON driver cannot roll back a transaction")
+
     def isDatabase(self, dbName):
         """
         Check if a database exist
@@ -309,7 +337,7 @@ class BasiumDriver(basium_driver.BaseDriver):
         """
         Count the number of objects, filtered by query
         """
-        if len(query._where) == 0:
+        if len(query._where) == 0 and not query.isGrouped():
             url = '%s/%s' % (self.uri, query.table())
         else:
             url = '%s/%s/filter?%s' % (self.uri, query.table(), query.encode())
@@ -317,11 +345,21 @@ class BasiumDriver(basium_driver.BaseDriver):
         count = resp.getheader("X-Result-Count")
         return int(count)
 
-    def select(self, query):
+    def exists(self, query):
+        """
+        Check if there is at least one row matching the query
+        The server checks, only the result is returned
+        """
+        url = '%s/%s/exists?%s' % (self.uri, query.table(), query.encode())
+        data, resp = self.execute(method='GET', url=url, decode=True)
+        return bool(data)
+
+    def select(self, query, stream=False):
         """
         Fetch one or multiple rows from a database
-        Returns an object that can be iterated over, returning rows
+        Returns a cursor that can be iterated over, returning rows as tuples
         If there is any errors, an DriverError exception is raised
+        stream is ignored, the whole result is returned by the server
 
         two different formats:
           simple: <url>/<table>/<id>
@@ -335,13 +373,29 @@ class BasiumDriver(basium_driver.BaseDriver):
             # real query
             url = '%s/%s/filter?%s' % (self.uri, query.table(), query.encode())
         data, resp = self.execute(method='GET', url=url, decode=True)
-        return data
+        if len(data) == 0:
+            names = query.columnNames()
+            if names is None:
+                names = list(query._model._columns.keys())
+            return basium_driver.ListCursor([], names)
+        names = list(data[0].keys())
+        rows = [tuple([row[name] for name in names]) for row in data]
+        return basium_driver.ListCursor(rows, names)
 
     def insert(self, table, values):
         url = '%s/%s' % (self.uri, table)
         data, resp = self.execute(method='POST', url=url, data=values, decode=True)
         return data
 
+    def insertMany(self, table, rows):
+        """
+        Insert multiple rows with one HTTP request
+        The rows are sent as a JSON list in the 'rows' form field
+        """
+        url = '%s/%s/_batch' % (self.uri, table)
+        data, resp = self.execute(method='POST', url=url, data={'rows': json.dumps(rows)}, decode=True)
+        return data
+
     def update(self, table, values):
         url = '%s/%s/%s' % (self.uri, table, values['_id'])
         data, resp = self.execute(method='PUT', url=url, data=values, decode=True)
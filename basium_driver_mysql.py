@@ -77,7 +77,7 @@ class BooleanCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         if value:
             return 1
         return 0
@@ -87,6 +87,7 @@ class DateCol(basium_driver.Column):
     """
     Stores a date
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = "date"
@@ -107,7 +108,7 @@ class DateCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -117,6 +118,7 @@ class DateTimeCol(basium_driver.Column):
     ignores microseconds
     if default is 'NOW' the current date+time is stored
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = 'datetime'
@@ -139,6 +141,7 @@ class DecimalCol(basium_driver.Column):
     stores a fixed precision number
     we cheat and represent this as a float in python
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = 'decimal(%d,%d)' % (self.maxdigits, self.decimal)
@@ -159,7 +162,7 @@ class DecimalCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -167,6 +170,7 @@ class FloatCol(basium_driver.Column):
     """
     Stores a floating point number
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = "float"
@@ -185,7 +189,7 @@ class FloatCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return str(value)
 
 
@@ -193,6 +197,7 @@ class IntegerCol(basium_driver.Column):
     """
     Stores an integer
     """
+    nativeType = True
 
     def typeToSql(self):
         if self.primary_key:
@@ -214,7 +219,7 @@ class IntegerCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -235,6 +240,15 @@ class VarcharCol(basium_driver.Column):
         return sql
 
 
+class ReferenceCol(IntegerCol):
+    """
+    Stores the _id of a row in another table
+    """
+
+    def toSql(self, value):
+        return value    # None is stored as NULL, no reference
+
+
 class Action:
     def __init__(self, msg=None, unattended=None, sqlcmd=None):
         self.msg = msg
@@ -254,44 +268,69 @@ class MySQLCursorDict(mysql.connector.cursor.MySQLCursor):
         return None
 
 
-class BasiumDriver(basium_driver.BaseDriver):
+class BasiumDriver(basium_driver.PooledDriver):
     def __init__(self, log=None, dbconf=None):
         self.log = log
         self.dbconf = dbconf
         self.dbconf.database = self.dbconf.database
 
-        self.dbconnection = None
         self.connectionStatus = None
         self.tables = None
+        self.autoinc = None
+        self.sqlcache = basium_driver.SqlCache()   # compiled SQL statements, see Query.shape()
+        self.maxParams = 65535  # limit for placeholders in a prepared statement
+        self.initPool()      # connection, cursor and txdepth are per thread
 
-    def connect(self):
+    def newConnection(self):
+        """Open a new connection, called by the pool"""
         try:
             if not self.dbconf.port:
                 self.dbconf.port = 3306
-            self.dbconnection = mysql.connector.connect(
+            dbconnection = mysql.connector.connect(
                                     host=self.dbconf.host,
                                     port=int(self.dbconf.port),
                                     user=self.dbconf.username,
                                     passwd=self.dbconf.password,
                                     db=self.dbconf.database)
-            self.cursor = self.dbconnection.cursor(cursor_class=MySQLCursorDict)
+            cursor = dbconnection.cursor()
             sql = "set autocommit=1;"
             if self.debug & bc.DEBUG_SQL:
                 self.log.debug('SQL=%s' % sql)
-            self.cursor.execute(sql)
-            if self.dbconnection:
-                self.dbconnection.commit()
+            cursor.execute(sql)
+            dbconnection.commit()
+            cursor.close()
         except mysql.connector.Error as err:
             raise bc.Error(err.errno, str(err))
+        return dbconnection
 
-    def disconnect(self):
-        self.dbconnection = None
-        self.tables = None
+    def newCursor(self, dbconnection):
+        try:
+            return dbconnection.cursor(cursor_class=MySQLCursorDict)
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
 
-    def execute(self, sql, values=None, commit=False):
+    def pingConnection(self, dbconnection):
+        """Health check, done by the pool before an unused connection is handed out"""
+        try:
+            return dbconnection.is_connected()
+        except mysql.connector.Error:
+            return False
+
+    def closeConnection(self, dbconnection):
+        try:
+            dbconnection.close()
+        except mysql.connector.Error:
+            pass
+
+    def execute(self, sql, values=None, commit=False, newcursor=False, servercursor=False):
         """
         Execute a query,
         if error try to reconnect and redo the query to handle timeouts
+        If newcursor is True the query is executed on a new buffered
+        cursor returning tuples, so other queries does not overwrite the result
+        If servercursor is True the new cursor is unbuffered instead, rows
+        are read from the server when fetched
+        Returns the cursor used
         """
         for i in range(0, 2):
             if self.dbconnection is None:
@@ -299,14 +338,23 @@ class BasiumDriver(basium_driver.BaseDriver):
                 if self.debug & bc.DEBUG_SQL:
                     self.log.debug('SQL=%s, values=%s' % (sql, values))
             try:
+                if servercursor:
+                    cursor = self.dbconnection.cursor(buffered=False)
+                elif newcursor:
+                    cursor = self.dbconnection.cursor(buffered=True)
+                else:
+                    cursor = self.cursor
                 if values is not None:
-                    self.cursor.execute(sql, values)
+                    cursor.execute(sql, values)
                 else:
-                    self.cursor.execute(sql)
-                if commit:
+                    cursor.execute(sql)
+                if commit and self.txdepth == 0:
                     self.dbconnection.commit()
-                return
+                return cursor
             except mysql.connector.Error as err:
+                if self.txdepth > 0:
+                    # no reconnect, the transaction would be lost
+                    raise bc.Error(err.errno, str(err))
                 if self.dbconnection is not None:
                     try:
                         self.dbconnection.commit()
@@ -316,6 +364,49 @@ class BasiumDriver(basium_driver.BaseDriver):
                     raise bc.Error(err.errno, str(err))
                 self.disconnect()
 
+    @basium_driver.pooled
+    def begin(self):
+        """
+        Start a transaction, nothing is committed until the outermost
+        transaction is committed. A nested transaction is a savepoint
+        """
+        if self.dbconnection is None:
+            self.connect()
+        try:
+            if self.txdepth == 0:
+                self.cursor.execute("START TRANSACTION")
+            else:
+                self.cursor.execute("SAVEPOINT basium_%d" % self.txdepth)
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+        self.txdepth += 1
+
+    @basium_driver.pooled
+    def commit(self):
+        """Commit the innermost transaction"""
+        self.txdepth -= 1
+        try:
+            if self.txdepth == 0:
+                self.dbconnection.commit()
+            else:
+                self.cursor.execute("RELEASE SAVEPOINT basium_%d" % self.txdepth)
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+
+    @basium_driver.pooled
+    def rollback(self):
+        """Roll back the innermost transaction"""
+        self.txdepth -= 1
+        try:
+            if self.txdepth == 0:
+                self.dbconnection.rollback()
+            else:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT basium_%d" % self.txdepth)
+                self.cursor.execute("RELEASE SAVEPOINT basium_%d" % self.txdepth)
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+
+    @basium_driver.pooled
     def isDatabase(self, dbName):
         """
         Returns True if the database exist
@@ -331,6 +422,7 @@ class BasiumDriver(basium_driver.BaseDriver):
             raise bc.Error(err.errno, str(err))
         return exist
 
+    @basium_driver.pooled
     def isTable(self, tableName):
         """
         Returns True if the table exist
@@ -348,6 +440,7 @@ class BasiumDriver(basium_driver.BaseDriver):
                 raise bc.Error(err.errno, str(err))
         return tableName in self.tables
 
+    @basium_driver.pooled
     def createTable(self, obj):
         """
         Create a tablet
@@ -359,7 +452,20 @@ class BasiumDriver(basium_driver.BaseDriver):
         sql += "\n  ,".join(columnlist)
         sql += '\n)'
         self.execute(sql, commit=True)
+        for index in obj._indexes:
+            self.execute(self.indexToSql(obj, index), commit=True)
 
+    def indexToSql(self, obj, index):
+        """
+        Returns the sql statement that creates an index
+        """
+        if index.unique:
+            unique = 'UNIQUE '
+        else:
+            unique = ''
+        return 'CREATE %sINDEX %s ON %s (%s)' % (unique, index.name, obj._table, ", ".join(index.columns))
+
+    @basium_driver.pooled
     def verifyTable(self, obj):
         """
         Verify that a table has the correct definition
@@ -404,12 +510,64 @@ class BasiumDriver(basium_driver.BaseDriver):
                         unattended=False,
                         sqlcmd='ALTER TABLE %s DROP %s' % (obj._table, colname)
                         ))
+        actions += self.verifyIndexes(obj)
         if len(actions) < 1:
             self.log.debug("SQL Table '%s' matches the object" % obj._table)
         else:
             self.log.debug("SQL Table '%s' DOES NOT match the object, need changes" % obj._table)
         return actions
 
+    @basium_driver.pooled
+    def verifyIndexes(self, obj):
+        """
+        Verify that the indexes in the table are the same as in the object
+        The primary key is not checked
+        Returns list of Action, zero length if nothing needs to be done
+        """
+        self.execute('SHOW INDEX FROM %s' % obj._table)
+        tableindexes = {}
+        rows = self.cursor.fetchall()
+        for row in sorted(rows, key=lambda row: row["Seq_in_index"]):
+            if row["Key_name"] == 'PRIMARY':
+                continue
+            if row["Key_name"] not in tableindexes:
+                tableindexes[row["Key_name"]] = [row["Non_unique"] == 0, []]
+            tableindexes[row["Key_name"]][1].append(row["Column_name"])
+
+        actions = []
+        for index in obj._indexes:
+            if index.name in tableindexes:
+                if tableindexes[index.name] == [index.unique, index.columns]:
+                    continue
+                msg = "Error: Index '%s' has incorrect definition in SQL Table. Action: Recreate index" % (index.name)
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug(msg)
+                actions.append(Action(
+                        msg=msg,
+                        unattended=True,
+                        sqlcmd='DROP INDEX %s ON %s' % (index.name, obj._table)
+                        ))
+            else:
+                msg = "Error: Index '%s' does not exist in the SQL Table. Action: Create index" % (index.name)
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug(" " + msg)
+            actions.append(Action(
+                    msg=msg,
+                    unattended=True,
+                    sqlcmd=self.indexToSql(obj, index)
+                    ))
+
+        names = [index.name for index in obj._indexes]
+        for name in tableindexes:
+            if name not in names:
+                actions.append(Action(
+                        msg="Error: Index '%s' in SQL Table NOT used, should be removed" % name,
+                        unattended=False,
+                        sqlcmd='DROP INDEX %s ON %s' % (name, obj._table)
+                        ))
+        return actions
+
+    @basium_driver.pooled
     def modifyTable(self, obj, actions):
         """
         Update table to latest definition of class
@@ -459,10 +617,19 @@ class BasiumDriver(basium_driver.BaseDriver):
         self.dbconnection.commit()
         return False
 
+    @basium_driver.pooled
     def count(self, query):
-        sql = "select count(*) from %s" % (query.table())
         sql2, values = query.toSql()
-        sql += sql2
+        key = ('count', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            if query.isGrouped():
+                # count the groups
+                sql = "select count(*) from (SELECT 1 FROM %s%s) AS grouped" % (query.table(), sql2)
+            else:
+                sql = "select count(*) from %s" % (query.table())
+                sql += sql2
+            self.sqlcache[key] = sql
         self.execute(sql, values)
         try:
             row = self.cursor.fetchone()
@@ -473,51 +640,156 @@ class BasiumDriver(basium_driver.BaseDriver):
             raise bc.Error(err.errno, str(err))
         return rows
 
-    def select(self, query):
+    @basium_driver.pooled
+    def exists(self, query):
+        """
+        Check if there is at least one row matching the query
+        Returns True or False
+        """
+        sql2, values = query.toSql()
+        key = ('exists', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "SELECT 1 FROM %s" % (query.table())
+            sql += sql2
+            self.sqlcache[key] = sql
+        self.execute(sql, values)
+        try:
+            rows = self.cursor.fetchall()
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+        return len(rows) > 0
+
+    @basium_driver.pooled
+    def select(self, query, stream=False):
         """
         Fetch one or multiple rows from a database
-        Returns an object that can be iterated over, returning rows
+        Returns a cursor that can be iterated over, returning rows as tuples
         If there is any errors, an DriverError exception is raised
+
+        If stream is True and dbconf.serverCursor is set, the cursor is
+        unbuffered so the rows are not read into memory in advance. Note
+        that no other queries can be done on the connection until all
+        rows have been read
         """
-        sql = "SELECT * FROM %s" % query.table()
         sql2, values = query.toSql()
-        sql += sql2
-        self.execute(sql, values)
-        return self.cursor
+        key = ('select', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "SELECT %s FROM %s" % (query.selectSql(), query.table())
+            sql += sql2
+            self.sqlcache[key] = sql
+        servercursor = stream and self.dbconf.serverCursor
+        cursor = self.execute(sql, values, newcursor=True, servercursor=servercursor)
+        if servercursor:
+            self.local.streams.append(cursor)   # keep the connection until all rows are read
+        return cursor
+
+    def fetchIter(self, cursor, batchsize):
+        """
+        Fetch rows from a cursor returned by select(), batchsize rows at a time
+        Generator, yields one row at a time
+        The cursor is closed when all rows are read, and the connection
+        is returned to the pool
+        """
+        try:
+            while True:
+                try:
+                    rows = cursor.fetchmany(batchsize)
+                except mysql.connector.Error as err:
+                    raise bc.Error(err.errno, str(err))
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                pass
+            self.closeStream(cursor)
 
+    @basium_driver.pooled
     def insert(self, table, values):
         """
         Insert a row in the table
         value is a dictionary with columns, primary key '_id' is ignored
         """
-        parms = []
-        holder = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append(key)
-                holder.append("%s")
-                vals.append(val)
-        sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
+        key = ('insert', table, tuple(values.keys()))
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            parms = [colname for colname in values.keys() if colname != '_id']
+            holder = ["%s"] * len(parms)
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
+            self.sqlcache[key] = sql
+        vals = [val for colname, val in values.items() if colname != '_id']
         self.execute(sql, vals, commit=True)
         return self.cursor.lastrowid
 
+    @basium_driver.pooled
+    def insertMany(self, table, rows):
+        """
+        Insert multiple rows in the table, in one transaction
+        rows is a list of dictionaries with columns, primary key '_id' is ignored
+        Returns list with the _id of the new rows
+
+        With innodb_autoinc_lock_mode 0 or 1 mysql allocates consecutive ids
+        for a multi-row insert, so all rows are sent in one statement and
+        the ids are calculated from the first one. Otherwise the rows are
+        inserted one by one, but still committed once
+        """
+        if len(rows) == 0:
+            return []
+        if self.autoinc is None:
+            sql = "SELECT @@innodb_autoinc_lock_mode AS lockmode, @@auto_increment_increment AS increment"
+            self.execute(sql)
+            try:
+                row = self.cursor.fetchone()
+            except mysql.connector.Error as err:
+                raise bc.Error(err.errno, str(err))
+            self.autoinc = (int(row['lockmode']) < 2, int(row['increment']))
+        consecutive, increment = self.autoinc
+
+        parms = [key for key in rows[0].keys() if key != '_id']
+        holder = "( %s )" % ",".join(["%s"] * len(parms))
+        if consecutive:
+            vals = []
+            for values in rows:
+                vals.extend([values[key] for key in parms])
+            sql = "INSERT INTO %s ( %s ) VALUES %s" % (table, ",".join(parms), ",".join([holder] * len(rows)))
+            self.execute(sql, vals, commit=True)
+            first = self.cursor.lastrowid
+            return [first + i * increment for i in range(0, len(rows))]
+
+        sql = "INSERT INTO %s ( %s ) VALUES %s" % (table, ",".join(parms), holder)
+        self.begin()
+        ids = []
+        try:
+            for values in rows:
+                self.execute(sql, [values[key] for key in parms])
+                ids.append(self.cursor.lastrowid)
+        except bc.Error:
+            self.rollback()
+            raise
+        self.commit()
+        return ids
+
+    @basium_driver.pooled
     def update(self, table, values):
         """
         Update a row in the table
         """
-        parms = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append("%s=%%s" % key)
-                vals.append(val)
-            else:
-                primary_key_val = val
-        sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
-        vals.append(primary_key_val)
+        key = ('update', table, tuple(values.keys()))
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            parms = ["%s=%%s" % colname for colname in values.keys() if colname != '_id']
+            sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
+            self.sqlcache[key] = sql
+        vals = [val for colname, val in values.items() if colname != '_id']
+        vals.append(values['_id'])
         self.execute(sql, vals, commit=True)
 
+    @basium_driver.pooled
     def delete(self, query):
         """
         delete a row from a table
@@ -525,10 +797,14 @@ class BasiumDriver(basium_driver.BaseDriver):
         refuses to delete all rows in a table (empty query)
         returns number of rows deleted
         """
-        sql = "DELETE FROM %s" % query.table()
         sql2, values = query.toSql()
         if sql2 == '':
             raise bc.Error(1, 'delete() with empty query not accepted')
-        sql += sql2
+        key = ('delete', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "DELETE FROM %s" % query.table()
+            sql += sql2
+            self.sqlcache[key] = sql
         self.execute(sql, values, commit=True)
         return self.cursor.rowcount
@@ -57,6 +57,8 @@ if err:
 
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+# numeric as Decimal, date and timestamp are converted by psycopg2, see nativeType
+psycopg2.extensions.register_type(psycopg2.extensions.DECIMAL)
 
 
 #
@@ -98,6 +100,7 @@ class BooleanCol(basium_driver.Column):
     """
     Stores boolean as number: 0 or 1
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = "boolean"
@@ -117,7 +120,7 @@ class BooleanCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         if value:
             return 'TRUE'
         return 'FALSE'
@@ -127,6 +130,7 @@ class DateCol(basium_driver.Column):
     """
     Stores a date
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = "date"
@@ -147,7 +151,7 @@ class DateCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -156,6 +160,7 @@ class DateTimeCol(basium_driver.Column):
     Stores date+time
     ignores microseconds
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = 'timestamp without time zone'
@@ -178,6 +183,7 @@ class DecimalCol(basium_driver.Column):
     stores a fixed precision number
     we cheat and represent this as a float in python
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = 'decimal(%d,%d)' % (self.maxdigits, self.decimal)
@@ -198,7 +204,7 @@ class DecimalCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -206,6 +212,7 @@ class FloatCol(basium_driver.Column):
     """
     Stores a floating point number
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = "float"
@@ -224,7 +231,7 @@ class FloatCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return str(value)
 
 
@@ -232,6 +239,7 @@ class IntegerCol(basium_driver.Column):
     """
     Stores an integer
     """
+    nativeType = True
 
     def typeToSql(self):
         if self.primary_key:
@@ -253,7 +261,7 @@ class IntegerCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -274,6 +282,15 @@ class VarcharCol(basium_driver.Column):
         return sql
 
 
+class ReferenceCol(IntegerCol):
+    """
+    Stores the _id of a row in another table
+    """
+
+    def toSql(self, value):
+        return value    # None is stored as NULL, no reference
+
+
 class Action:
     def __init__(self, msg=None, unattended=None, sqlcmd=None):
         self.msg = msg
@@ -281,32 +298,71 @@ class Action:
         self.sqlcmd = sqlcmd
 
 
-class BasiumDriver(basium_driver.BaseDriver):
+class BasiumDriver(basium_driver.PooledDriver):
     def __init__(self, log=None, dbconf=None):
         self.log = log
         self.dbconf = dbconf
-        self.dbconnection = None
         self.connectionStatus = None
         self.tables = None
+        self.sqlcache = basium_driver.SqlCache()   # compiled SQL statements, see Query.shape()
+        self.maxParams = 65535  # limit for parameters in the protocol
+        self.cursorid = 0    # used to create unique names for server side cursors
+        self.initPool()      # connection, cursor and txdepth are per thread
 
-    def connect(self):
+    def newConnection(self):
+        """Open a new connection, called by the pool"""
         try:
             if not self.dbconf.port:
                 self.dbconf.port = 5432
-            self.dbconnection = psycopg2.connect(
+            return psycopg2.connect(
                 host=self.dbconf.host, port=self.dbconf.port, user=self.dbconf.username, password=self.dbconf.password, dbname=self.dbconf.database)
-            self.cursor = self.dbconnection.cursor(cursor_factory=psycopg2.extras.DictCursor)
         except psycopg2.DatabaseError as e:
             raise bc.Error(1, str(e))
 
-    def disconnect(self):
-        self.dbconnection = None
-        self.tables = None
+    def newCursor(self, dbconnection):
+        try:
+            return dbconnection.cursor()
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+
+    def pingConnection(self, dbconnection):
+        """Health check, done by the pool before an unused connection is handed out"""
+        if dbconnection.closed:
+            return False
+        try:
+            cursor = dbconnection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            dbconnection.rollback()
+        except psycopg2.DatabaseError:
+            return False
+        return True
 
-    def execute(self, sql, values=None, commit=False):
+    def resetConnection(self, dbconnection):
+        """
+        End the transaction psycopg2 started implicitly with the first
+        query, all changes are already committed
+        """
+        try:
+            dbconnection.rollback()
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+
+    def closeConnection(self, dbconnection):
+        try:
+            dbconnection.close()
+        except psycopg2.DatabaseError:
+            pass
+
+    def execute(self, sql, values=None, commit=False, newcursor=False, servercursor=False):
         """
         Execute a query
         If error try to reconnect and redo the query to handle timeouts
+        If newcursor is True the query is executed on a new cursor, so
+        other queries does not overwrite the result
+        If servercursor is True the new cursor is a named server side
+        cursor, rows are kept in the server until they are fetched
+        Returns the cursor used
         """
         for i in range(0, 2):
             if self.dbconnection is None:
@@ -314,16 +370,26 @@ class BasiumDriver(basium_driver.BaseDriver):
             try:
                 if self.debug & bc.DEBUG_SQL:
                     self.log.debug(self.cursor.mogrify(sql, values))
+                if servercursor:
+                    # withhold, so the cursor survives commits done while iterating
+                    self.cursorid += 1
+                    cursor = self.dbconnection.cursor(name='basium_cursor_%d' % self.cursorid, withhold=True)
+                    cursor.itersize = self.dbconf.batchsize
+                elif newcursor:
+                    cursor = self.dbconnection.cursor()
+                else:
+                    cursor = self.cursor
                 if values is not None:
-                    self.cursor.execute(sql, values)
+                    cursor.execute(sql, values)
                 else:
-                    self.cursor.execute(sql)
-                if commit:
+                    cursor.execute(sql)
+                if commit and self.txdepth == 0:
                     self.dbconnection.commit()
-                return
+                return cursor
 
             except psycopg2.DatabaseError as e:
-                if i == 1:
+                if i == 1 or self.txdepth > 0:
+                    # no reconnect inside a transaction, it would be lost
                     raise bc.Error(1, str(e))
                 self.disconnect()
 #                    try:
@@ -331,6 +397,48 @@ class BasiumDriver(basium_driver.BaseDriver):
 #                    except psycopg2.DatabaseError, e:
 #                        pass
 
+    @basium_driver.pooled
+    def begin(self):
+        """
+        Start a transaction, nothing is committed until the outermost
+        transaction is committed. A nested transaction is a savepoint
+        """
+        if self.dbconnection is None:
+            self.connect()
+        try:
+            # psycopg2 starts the outermost transaction with the first statement
+            if self.txdepth > 0:
+                self.cursor.execute("SAVEPOINT basium_%d" % self.txdepth)
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+        self.txdepth += 1
+
+    @basium_driver.pooled
+    def commit(self):
+        """Commit the innermost transaction"""
+        self.txdepth -= 1
+        try:
+            if self.txdepth == 0:
+                self.dbconnection.commit()
+            else:
+                self.cursor.execute("RELEASE SAVEPOINT basium_%d" % self.txdepth)
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+
+    @basium_driver.pooled
+    def rollback(self):
+        """Roll back the innermost transaction"""
+        self.txdepth -= 1
+        try:
+            if self.txdepth == 0:
+                self.dbconnection.rollback()
+            else:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT basium_%d" % self.txdepth)
+                self.cursor.execute("RELEASE SAVEPOINT basium_%d" % self.txdepth)
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+
+    @basium_driver.pooled
     def isDatabase(self, dbName):
         """
         Returns True if the database exist
@@ -346,6 +454,7 @@ class BasiumDriver(basium_driver.BaseDriver):
             raise bc.Error(1, str(e))
         return exist
 
+    @basium_driver.pooled
     def isTable(self, tableName):
         """
         Returns True if the table exist
@@ -362,6 +471,7 @@ class BasiumDriver(basium_driver.BaseDriver):
                 raise bc.Error(1, str(e))
         return tableName in self.tables
 
+    @basium_driver.pooled
     def createTable(self, obj):
         """
         Create a table
@@ -373,7 +483,21 @@ class BasiumDriver(basium_driver.BaseDriver):
         sql += ",".join(columnlist)
         sql += ')'
         self.execute(sql, commit=True)
+        for index in obj._indexes:
+            self.execute(self.indexToSql(obj, index), commit=True)
 
+    def indexToSql(self, obj, index):
+        """
+        Returns the sql statement that creates an index
+        """
+        if index.unique:
+            unique = 'UNIQUE '
+        else:
+            unique = ''
+        columns = ",".join(['"%s"' % colname for colname in index.columns])
+        return 'CREATE %sINDEX "%s" ON %s (%s)' % (unique, index.name, obj._table, columns)
+
+    @basium_driver.pooled
     def verifyTable(self, obj):
         """
         Verify that a table has the correct definition
@@ -430,54 +554,127 @@ class BasiumDriver(basium_driver.BaseDriver):
 #            self.log.debug("SQL Table '%s' matches the object" % obj._table)
 #        else:
 #            self.log.debug("SQL Table '%s' DOES NOT match the object, need changes" % obj._table)
+        actions += self.verifyIndexes(obj)
         return actions
 
+    @basium_driver.pooled
+    def verifyIndexes(self, obj):
+        """
+        Verify that the indexes in the table are the same as in the object
+        The primary key is not checked
+        Returns list of Action, zero length if nothing needs to be done
+        """
+        sql = "SELECT i.relname, ix.indisunique, a.attname FROM pg_index ix"
+        sql += " JOIN pg_class t ON t.oid = ix.indrelid"
+        sql += " JOIN pg_class i ON i.oid = ix.indexrelid"
+        sql += " JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(ix.indkey)"
+        sql += " WHERE t.oid = %s::regclass AND NOT ix.indisprimary"
+        sql += " ORDER BY i.relname, array_position(ix.indkey::int2[], a.attnum)"
+        self.execute(sql, (obj._table,))    # the table is found through search_path
+        tableindexes = {}
+        try:
+            for row in self.cursor.fetchall():
+                if row[0] not in tableindexes:
+                    tableindexes[row[0]] = [row[1], []]
+                tableindexes[row[0]][1].append(row[2])
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+
+        actions = []
+        for index in obj._indexes:
+            if index.name in tableindexes:
+                if tableindexes[index.name] == [index.unique, index.columns]:
+                    continue
+                msg = "Error: Index '%s' has incorrect definition in SQL Table. Action: Recreate index" % (index.name)
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug(msg)
+                actions.append(Action(
+                        msg=msg,
+                        unattended=True,
+                        sqlcmd='DROP INDEX "%s"' % index.name
+                        ))
+            else:
+                msg = "Error: Index '%s' does not exist in the SQL Table. Action: Create index" % (index.name)
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug(" " + msg)
+            actions.append(Action(
+                    msg=msg,
+                    unattended=True,
+                    sqlcmd=self.indexToSql(obj, index)
+                    ))
+
+        names = [index.name for index in obj._indexes]
+        for name in tableindexes:
+            if name not in names:
+                actions.append(Action(
+                        msg="Error: Index '%s' in SQL Table NOT used, should be removed" % name,
+                        unattended=False,
+                        sqlcmd='DROP INDEX "%s"' % name
+                        ))
+        return actions
+
+    @basium_driver.pooled
     def modifyTable(self, obj, actions):
         """
         Update table to latest definition of class
         actions is the result from verifyTable
         Returns True if everything is ok
         """
-#        response = Response()
-#        self.log.debug("Updating table %s" % obj._table)
-#        if len(actions) == 0:
-#            self.log.debug("  Nothing to do")
-#            return True
-#
-#        print("Actions that needs to be done:")
-#        askForConfirmation = False
-#        for action in actions:
-#            print("  " + action.msg)
-#            print("   SQL: " + action.sqlcmd)
-#            if not action.unattended:
-#                askForConfirmation = True
-#
-#        if askForConfirmation:
-#            print("WARNING: removal of columns can lead to data loss.")
-#            a = raw_input('Are you sure (yes/No)? ')
-#            if a != 'yes':
-#                print("Aborted!")
-#                return False
-#
-#        # we first remove columns, so we dont get into conflicts
-#        # with the new columns, for example changing primary key (there can only be one primary key)
-#        for action in actions:
-#            if 'DROP' in action.sqlcmd:
-#                print("Fixing " + action.msg)
-#                print("  Cmd: " + action.sqlcmd)
-#                self.cursor.execute(action.sqlcmd)
-#        for action in actions:
-#            if not 'DROP' in action.sqlcmd:
-#                print("Fixing " + action.msg)
-#                print("  Cmd: " + action.sqlcmd)
-#                self.cursor.execute(action.sqlcmd)
-#        self.dbconnection.commit()
+        if self.debug & bc.DEBUG_TABLE_MGMT:
+            self.log.debug("Updating table %s" % obj._table)
+        if len(actions) == 0:
+            if self.debug & bc.DEBUG_TABLE_MGMT:
+                self.log.debug("  Nothing to do")
+            return True
+
+        if self.debug & bc.DEBUG_TABLE_MGMT:
+            self.log.debug("Actions that needs to be done:")
+        askForConfirmation = False
+        for action in actions:
+            if self.debug & bc.DEBUG_TABLE_MGMT:
+                self.log.debug("  " + action.msg)
+                self.log.debug("   SQL: " + action.sqlcmd)
+            if not action.unattended:
+                askForConfirmation = True
+
+        if askForConfirmation:
+            if self.debug & bc.DEBUG_TABLE_MGMT:
+                self.log.debug("WARNING: removal of columns can lead to data loss.")
+            a = input('Are you sure (yes/No)? ')
+            if a != 'yes':
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug("Aborted!")
+                return False
+
+        # we first remove columns and indexes, so we dont get into conflicts
+        # with the new ones, for example recreating an index with the same name
+        for action in actions:
+            if 'DROP' in action.sqlcmd:
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug("Fixing " + action.msg)
+                    self.log.debug("  Cmd: " + action.sqlcmd)
+                self.execute(action.sqlcmd, commit=True)
+        for action in actions:
+            if 'DROP' not in action.sqlcmd:
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug("Fixing " + action.msg)
+                    self.log.debug("  Cmd: " + action.sqlcmd)
+                self.execute(action.sqlcmd, commit=True)
         return True
 
+    @basium_driver.pooled
     def count(self, query):
-        sql = "select count(*) from %s" % (query.table())
         sql2, values = query.toSql()
-        sql += sql2
+        key = ('count', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            if query.isGrouped():
+                # count the groups
+                sql = "select count(*) from (SELECT 1 FROM %s%s) AS grouped" % (query.table(), sql2)
+            else:
+                sql = "select count(*) from %s" % (query.table())
+                sql += sql2
+            self.sqlcache[key] = sql
 
         self.execute(sql, values)
         try:
@@ -489,32 +686,87 @@ class BasiumDriver(basium_driver.BaseDriver):
             raise bc.Error(1, str(e))
         return data
 
-    def select(self, query):
+    @basium_driver.pooled
+    def exists(self, query):
+        """
+        Check if there is at least one row matching the query
+        Returns True or False
+        """
+        sql2, values = query.toSql()
+        key = ('exists', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "SELECT 1 FROM %s" % (query.table())
+            sql += sql2
+            self.sqlcache[key] = sql
+        self.execute(sql, values)
+        try:
+            row = self.cursor.fetchone()
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+        return row is not None
+
+    @basium_driver.pooled
+    def select(self, query, stream=False):
         """
         Fetch one or multiple rows from a database
-        Returns an object that can be iterated over, returning rows
+        Returns a cursor that can be iterated over, returning rows as tuples
         If there is any errors, an exception is raised
+
+        If stream is True and dbconf.serverCursor is set, a server side
+        cursor is used, rows are transferred when they are fetched
         """
-        sql = "SELECT * FROM %s" % query.table()
         sql2, values = query.toSql()
-        sql += sql2
-        self.execute(sql, values)
-        return self.cursor
+        key = ('select', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "SELECT %s FROM %s" % (query.selectSql('"'), query.table())
+            sql += sql2
+            self.sqlcache[key] = sql
+        servercursor = stream and self.dbconf.serverCursor
+        cursor = self.execute(sql, values, newcursor=True, servercursor=servercursor)
+        if servercursor:
+            self.local.streams.append(cursor)   # keep the connection until all rows are read
+        return cursor
+
+    def fetchIter(self, cursor, batchsize):
+        """
+        Fetch rows from a cursor returned by select(), batchsize rows at a time
+        Generator, yields one row at a time
+        The cursor is closed when all rows are read, this also releases
+        a server side cursor and returns the connection to the pool
+        """
+        try:
+            while True:
+                try:
+                    rows = cursor.fetchmany(batchsize)
+                except psycopg2.DatabaseError as e:
+                    raise bc.Error(1, str(e))
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.DatabaseError:
+                pass
+            self.closeStream(cursor)
 
+    @basium_driver.pooled
     def insert(self, table, values):
         """
         Insert a row in the table
         value is a dictionary with columns, excluding primary key
         """
-        parms = []
-        holder = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append('"' + key + '"')
-                holder.append("%s")
-                vals.append(val)
-        sql = "INSERT INTO %s ( %s ) VALUES ( %s ) RETURNING _id" % (table, ",".join(parms), ",".join(holder))
+        key = ('insert', table, tuple(values.keys()))
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            parms = ['"' + colname + '"' for colname in values.keys() if colname != '_id']
+            holder = ["%s"] * len(parms)
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s ) RETURNING _id" % (table, ",".join(parms), ",".join(holder))
+            self.sqlcache[key] = sql
+        vals = [val for colname, val in values.items() if colname != '_id']
         self.execute(sql, vals, commit=True)
         try:
             data = self.cursor.fetchone()[0]
@@ -522,33 +774,60 @@ class BasiumDriver(basium_driver.BaseDriver):
             raise bc.Error(1, str(e))
         return data
 
+    @basium_driver.pooled
+    def insertMany(self, table, rows):
+        """
+        Insert multiple rows in the table, using one multi-row INSERT
+        rows is a list of dictionaries with columns, primary key '_id' is ignored
+        Returns list with the _id of the new rows, RETURNING gives them
+        in the same order as the VALUES list
+        """
+        if len(rows) == 0:
+            return []
+        parms = [key for key in rows[0].keys() if key != '_id']
+        holder = "( %s )" % ",".join(["%s"] * len(parms))
+        vals = []
+        for values in rows:
+            vals.extend([values[key] for key in parms])
+        sql = "INSERT INTO %s ( %s ) VALUES %s RETURNING _id" % (
+            table, ",".join(['"' + key + '"' for key in parms]), ",".join([holder] * len(rows)))
+        self.execute(sql, vals, commit=True)
+        try:
+            data = [row[0] for row in self.cursor.fetchall()]
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+        return data
+
+    @basium_driver.pooled
     def update(self, table, values):
         """
         Update a row in the table
         """
-        parms = []
-        vals = []
-        
-        for key, val in values.items():
-            if key != '_id':
-                parms.append('"%s"=%%s' % key)
-                vals.append(val)
-            else:
-                primary_key_val = val
-        sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
-        vals.append(primary_key_val)
+        key = ('update', table, tuple(values.keys()))
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            parms = ['"%s"=%%s' % colname for colname in values.keys() if colname != '_id']
+            sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
+            self.sqlcache[key] = sql
+        vals = [val for colname, val in values.items() if colname != '_id']
+        vals.append(values['_id'])
         self.execute(sql, vals, commit=True)
 
+    @basium_driver.pooled
     def delete(self, query):
         """
         delete a row from a table
         "DELETE FROM EMPLOYEE WHERE AGE > '%s'", (20, )
         returns number of rows deleted
         """
-        sql = "DELETE FROM %s" % query.table()
         sql2, values = query.toSql()
         if sql2 == '':
             raise bc.Error(1, 'Missing query on delete(), empty query is not accepted')
-        sql += sql2
+        key = ('delete', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "DELETE FROM %s" % query.table()
+            sql += sql2
+            self.sqlcache[key] = sql
         self.execute(sql, values, commit=True)
         return self.cursor.rowcount
@@ -39,6 +39,7 @@ media that needs to be reconnected
 
 import datetime
 import decimal
+import threading
 
 import basium_common as bc
 import basium_driver
@@ -52,6 +53,44 @@ if err:
     raise bc.Error(1, err)
 
 
+#
+# Native conversion, done by the sqlite3 module for the declared column
+# types, so the values in a row already have the python type
+# The converters are not called for NULL values. Older versions stored
+# None as the text 'NULL', that is also returned as None
+# Note: the registration is global for the sqlite3 module
+#
+def convertDate(value):
+    if value == b'NULL':
+        return None
+    try:
+        return datetime.date.fromisoformat(value[:10].decode())
+    except (ValueError, UnicodeDecodeError) as e:
+        raise bc.Error(1, "Cannot convert %s to a date, %s" % (value, e))
+
+
+def convertDateTime(value):
+    if value == b'NULL':
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.decode())
+    except (ValueError, UnicodeDecodeError) as e:
+        raise bc.Error(1, "Cannot convert %s to a datetime, %s" % (value, e))
+
+
+def convertBoolean(value):
+    if value == b'NULL':
+        return None
+    return value == b'1'
+
+
+sqlite3.register_adapter(datetime.date, datetime.date.isoformat)
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("date", convertDate)
+sqlite3.register_converter("datetime", convertDateTime)
+sqlite3.register_converter("tinyint", convertBoolean)
+
+
 class ColumnInfo:
     def __init__(self, arg):
         self.cid = arg["cid"]
@@ -66,6 +105,7 @@ class BooleanCol(basium_driver.Column):
     """
     Stores boolean as number: 0 or 1
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = "tinyint(1)"
@@ -85,7 +125,7 @@ class BooleanCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         if value:
             return 1
         return 0
@@ -95,6 +135,7 @@ class DateCol(basium_driver.Column):
     """
     Stores a date
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = "date"
@@ -110,12 +151,12 @@ class DateCol(basium_driver.Column):
         if isinstance(value, datetime.datetime):
             value = value.date()
         elif isinstance(value, str):
-            value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            value = datetime.date.fromisoformat(value[:10])
         return value
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -124,6 +165,7 @@ class DateTimeCol(basium_driver.Column):
     Stores date+time
     ignores microseconds
     """
+    nativeType = True
 
     def typeToSql(self):
         sql = 'datetime'
@@ -137,7 +179,7 @@ class DateTimeCol(basium_driver.Column):
 
     def toPython(self, value):
         if isinstance(value, str):
-            value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+            value = datetime.datetime.fromisoformat(value)
         return value
 
 
@@ -167,13 +209,14 @@ class DecimalCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return float(value)
 
 
 class FloatCol(basium_driver.Column):
     """
     Stores a floating point number
+    Not a native type, older versions stored None as the text 'NULL'
     """
 
     def typeToSql(self):
@@ -193,13 +236,14 @@ class FloatCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return str(value)
 
 
 class IntegerCol(basium_driver.Column):
     """
     Stores an integer
+    Not a native type, older versions stored None as the text 'NULL'
     """
 
     def typeToSql(self):
@@ -222,7 +266,7 @@ class IntegerCol(basium_driver.Column):
 
     def toSql(self, value):
         if value is None:
-            return "NULL"
+            return None     # bound as NULL
         return value
 
 
@@ -244,6 +288,15 @@ class VarcharCol(basium_driver.Column):
         return sql
 
 
+class ReferenceCol(IntegerCol):
+    """
+    Stores the _id of a row in another table
+    """
+
+    def toSql(self, value):
+        return value    # None is stored as NULL, no reference
+
+
 class Action:
     def __init__(self, msg=None, unattended=None, sqlcmd=None):
         self.msg = msg
@@ -252,30 +305,80 @@ class Action:
 
 
 class BasiumDriver(basium_driver.BaseDriver):
+    """
+    Each thread uses its own connection, so threads does not share
+    cursors and readers can run in parallel. File databases use
+    write-ahead logging, so readers are not blocked by a writer.
+    A :memory: database only exist in its own connection, so all
+    threads share one connection
+    """
     def __init__(self, log=None, dbconf=None):
         self.log = log
         self.dbconf = dbconf
 
-        self.dbconnection = None
+        self.local = basium_driver.DriverLocal()    # connection, cursor and txdepth per thread
+        self.lock = threading.Lock()
+        self.shared = None   # the connection for a :memory: database
         self.tables = None
         self.connectionStatus = None
+        self.sqlcache = basium_driver.SqlCache()   # compiled SQL statements, see Query.shape()
+        self.maxParams = 999  # SQLITE_MAX_VARIABLE_NUMBER in older sqlite versions
+
+    @property
+    def dbconnection(self):
+        return self.local.dbconnection
+
+    @property
+    def cursor(self):
+        return self.local.cursor
+
+    @property
+    def txdepth(self):
+        return self.local.txdepth
+
+    @txdepth.setter
+    def txdepth(self, value):
+        self.local.txdepth = value
 
     def connect(self):
+        """
+        Open a connection for the calling thread
+        Waits up to dbconf.poolTimeout seconds if the database is locked by another connection
+        """
         try:
-            self.dbconnection = sqlite3.connect(self.dbconf.database,  check_same_thread=False)
-            self.dbconnection.row_factory = sqlite3.Row   # return querys as dictionaries
-            self.cursor = self.dbconnection.cursor()
+            if self.dbconf.database == ':memory:':
+                with self.lock:
+                    if self.shared is None:
+                        self.shared = sqlite3.connect(self.dbconf.database, check_same_thread=False,
+                                                      detect_types=sqlite3.PARSE_DECLTYPES)
+                dbconnection = self.shared
+            else:
+                dbconnection = sqlite3.connect(self.dbconf.database, timeout=self.dbconf.poolTimeout,
+                                               detect_types=sqlite3.PARSE_DECLTYPES)
+                dbconnection.execute("PRAGMA journal_mode=WAL")
+            self.local.cursor = dbconnection.cursor()
+            self.local.dbconnection = dbconnection
         except sqlite3.Error as e:
             raise bc.Error(1, e.args[0])
 
     def disconnect(self):
-        self.dbconnection = None
+        """Close the connection of the calling thread"""
+        if self.local.dbconnection is not None and self.local.dbconnection is not self.shared:
+            try:
+                self.local.dbconnection.close()
+            except sqlite3.Error:
+                pass
+        self.local.dbconnection = None
+        self.local.cursor = None
         self.tables = None
 
-    def execute(self, sql, values=None, commit=True):
+    def execute(self, sql, values=None, commit=True, newcursor=False):
         """
         Execute a query, if error try to reconnect and redo the query
         to handle timeouts
+        If newcursor is True the query is executed on a new cursor, so
+        other queries does not overwrite the result
+        Returns the cursor used
         """
         for i in range(0, 2):
             if self.dbconnection is None:
@@ -285,18 +388,62 @@ class BasiumDriver(basium_driver.BaseDriver):
                     self.log.debug('SQL=%s' % sql)
                     if values:
                         self.log.debug('   =%s' % values)
+                if newcursor:
+                    cursor = self.dbconnection.cursor()
+                else:
+                    cursor = self.cursor
                 if values is not None:
-                    self.cursor.execute(sql, values)
+                    cursor.execute(sql, values)
                 else:
-                    self.cursor.execute(sql)
-                if commit:
+                    cursor.execute(sql)
+                if commit and self.txdepth == 0:
                     self.dbconnection.commit()
-                return
+                return cursor
 
             except sqlite3.Error as e:
-                if i == 1:
+                if i == 1 or self.txdepth > 0:
                     raise bc.Error(1, e.args[0])
 
+    def begin(self):
+        """
+        Start a transaction, nothing is committed until the outermost
+        transaction is committed. A nested transaction is a savepoint
+        """
+        if self.dbconnection is None:
+            self.connect()
+        try:
+            if self.txdepth == 0:
+                if not self.dbconnection.in_transaction:
+                    self.cursor.execute("BEGIN")
+            else:
+                self.cursor.execute("SAVEPOINT basium_%d" % self.txdepth)
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+        self.txdepth += 1
+
+    def commit(self):
+        """Commit the innermost transaction"""
+        self.txdepth -= 1
+        try:
+            if self.txdepth == 0:
+                self.dbconnection.commit()
+            else:
+                self.cursor.execute("RELEASE SAVEPOINT basium_%d" % self.txdepth)
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+
+    def rollback(self):
+        """Roll back the innermost transaction"""
+        self.txdepth -= 1
+        try:
+            if self.txdepth == 0:
+                self.dbconnection.rollback()
+            else:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT basium_%d" % self.txdepth)
+                self.cursor.execute("RELEASE SAVEPOINT basium_%d" % self.txdepth)
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+
     def isDatabase(self, dbName):
         """
         Returns True if the database exist
@@ -331,8 +478,20 @@ class BasiumDriver(basium_driver.BaseDriver):
         sql += "  ,".join(columnlist)
         sql += ')'
         self.execute(sql)
+        for index in obj._indexes:
+            self.execute(self.indexToSql(obj, index))
         return True
 
+    def indexToSql(self, obj, index):
+        """
+        Returns the sql statement that creates an index
+        """
+        if index.unique:
+            unique = 'UNIQUE '
+        else:
+            unique = ''
+        return 'CREATE %sINDEX %s ON %s (%s)' % (unique, index.name, obj._table, ", ".join(index.columns))
+
     def tableTypeToSql(self, tabletype):
         """
         Map from sql query to table types
@@ -402,6 +561,59 @@ class BasiumDriver(basium_driver.BaseDriver):
                         unattended=False,
                         sqlcmd='ALTER TABLE %s DROP %s' % (obj._table, colname)
                         ))
+        actions += self.verifyIndexes(obj)
+        return actions
+
+    def verifyIndexes(self, obj):
+        """
+        Verify that the indexes in the table are the same as in the object
+        Only indexes created with CREATE INDEX are checked, not the
+        ones sqlite creates for the primary key
+        Returns list of Action, zero length if nothing needs to be done
+        """
+        self.execute("PRAGMA index_list([%s])" % obj._table)
+        # seq, name, unique, origin, partial
+        tableindexes = {}
+        for row in self.cursor.fetchall():
+            if row[3] == 'c':
+                tableindexes[row[1]] = [row[2] != 0, []]
+        for name, tableindex in tableindexes.items():
+            self.execute("PRAGMA index_info([%s])" % name)
+            # seqno, cid, name
+            for row in sorted(self.cursor.fetchall()):
+                tableindex[1].append(row[2])
+
+        actions = []
+        for index in obj._indexes:
+            if index.name in tableindexes:
+                if tableindexes[index.name] == [index.unique, index.columns]:
+                    continue
+                msg = "Error: Index '%s' has incorrect definition in SQL Table. Action: Recreate index" % (index.name)
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug(msg)
+                actions.append(Action(
+                        msg=msg,
+                        unattended=True,
+                        sqlcmd='DROP INDEX %s' % index.name
+                        ))
+            else:
+                msg = "Error: Index '%s' does not exist in the SQL Table. Action: Create index" % (index.name)
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug(" %s" % msg)
+            actions.append(Action(
+                    msg=msg,
+                    unattended=True,
+                    sqlcmd=self.indexToSql(obj, index)
+                    ))
+
+        names = [index.name for index in obj._indexes]
+        for name in tableindexes:
+            if name not in names:
+                actions.append(Action(
+                        msg="Error: Index '%s' in SQL Table NOT used, should be removed" % name,
+                        unattended=False,
+                        sqlcmd='DROP INDEX %s' % name
+                        ))
         return actions
 
     def modifyTable(self, obj, actions):
@@ -447,62 +659,129 @@ class BasiumDriver(basium_driver.BaseDriver):
         self.dbconnection.commit()
 
     def count(self, query):
-        sql = "select count(*) from %s" % (query.table())
         sql2, values = query.toSql()
-        sql += sql2
+        key = ('count', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            if query.isGrouped():
+                # count the groups
+                sql = "select count(*) from (SELECT 1 FROM %s%s) AS grouped" % (query.table(), sql2.replace("%s", "?"))
+            else:
+                sql = "select count(*) from %s" % (query.table())
+                sql += sql2.replace("%s", "?")
+            self.sqlcache[key] = sql
         self.execute(sql, values)
         try:
             row = self.cursor.fetchone()
             if row is not None:
-                key = 'count(*)'
-                rows = int(row[key])
+                rows = int(row[0])
             else:
                 raise bc.Error(1, 'Cannot query for count(*) in %s' % (query.table()))
         except sqlite3.Error as e:
             raise bc.Error(1, e.args[0])
         return rows
 
-    def select(self, query):
+    def exists(self, query):
+        """
+        Check if there is at least one row matching the query
+        Returns True or False
+        """
+        sql2, values = query.toSql()
+        key = ('exists', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "SELECT 1 FROM %s" % (query.table())
+            sql += sql2.replace("%s", "?")
+            self.sqlcache[key] = sql
+        self.execute(sql, values)
+        try:
+            row = self.cursor.fetchone()
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+        return row is not None
+
+    def select(self, query, stream=False):
         """
         Fetch one or multiple rows from a database
-        Returns an object that can be iterated over, returning rows
+        Returns a cursor that can be iterated over, returning rows as tuples
         If there is any errors, an exception is raised
+        stream is ignored, sqlite always fetches rows when they are read
         """
-        sql = "SELECT * FROM %s" % query.table()
         sql2, values = query.toSql()
-        sql += sql2.replace("%s", "?")
-        self.execute(sql, values)
-        return self.cursor
+        key = ('select', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "SELECT %s FROM %s" % (query.selectSql(), query.table())
+            sql += sql2.replace("%s", "?")
+            self.sqlcache[key] = sql
+        return self.execute(sql, values, newcursor=True)
+
+    def fetchIter(self, cursor, batchsize):
+        """
+        Fetch rows from a cursor returned by select(), batchsize rows at a time
+        Generator, yields one row at a time
+        """
+        while True:
+            try:
+                rows = cursor.fetchmany(batchsize)
+            except sqlite3.Error as e:
+                raise bc.Error(1, e.args[0])
+            if not rows:
+                break
+            for row in rows:
+                yield row
 
     def insert(self, table, values):
         """
         Insert a row in the table
         value is a dictionary with columns, primary key '_id' is ignored
         """
-        parms = []
-        holder = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append(key)
-                holder.append("?")
-                vals.append(val)
-        sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
+        key = ('insert', table, tuple(values.keys()))
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            parms = [colname for colname in values.keys() if colname != '_id']
+            holder = ["?"] * len(parms)
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
+            self.sqlcache[key] = sql
+        vals = [val for colname, val in values.items() if colname != '_id']
         self.execute(sql, vals, commit=True)
         return self.cursor.lastrowid
 
+    def insertMany(self, table, rows):
+        """
+        Insert multiple rows in the table, in one transaction
+        rows is a list of dictionaries with columns, primary key '_id' is ignored
+        All rows are inserted before commit, so there is only one write to disk.
+        If a row fails, none of the rows are inserted
+        Returns list with the _id of the new rows
+        """
+        if len(rows) == 0:
+            return []
+        parms = [key for key in rows[0].keys() if key != '_id']
+        holder = ["?"] * len(parms)
+        sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
+        self.begin()
+        ids = []
+        try:
+            for values in rows:
+                self.execute(sql, [values[key] for key in parms])
+                ids.append(self.cursor.lastrowid)
+        except bc.Error:
+            self.rollback()
+            raise
+        self.commit()
+        return ids
+
     def update(self, table, values):
         """Update a row in the table"""
-        parms = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append("%s=?" % key)
-                vals.append(val)
-            else:
-                primary_key_val = val
-        sql = "UPDATE %s SET %s WHERE _id=?" % (table, ",".join(parms))
-        vals.append(primary_key_val)
+        key = ('update', table, tuple(values.keys()))
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            parms = ["%s=?" % colname for colname in values.keys() if colname != '_id']
+            sql = "UPDATE %s SET %s WHERE _id=?" % (table, ",".join(parms))
+            self.sqlcache[key] = sql
+        vals = [val for colname, val in values.items() if colname != '_id']
+        vals.append(values['_id'])
         self.execute(sql, vals)
 
     def delete(self, query):
@@ -511,11 +790,15 @@ class BasiumDriver(basium_driver.BaseDriver):
          "DELETE FROM EMPLOYEE WHERE AGE > '%d'" % (20)
         returns number of rows deleted
         """
-        sql = "DELETE FROM %s" % query.table()
         sql2, values = query.toSql()
         if sql2 == '':
             raise bc.Error(1, 'Missing query on delete(), empty query is not accepted')
-        sql += sql2.replace("%s", "?")
+        key = ('delete', query.shape())
+        sql = self.sqlcache.get(key)
+        if sql is None:
+            sql = "DELETE FROM %s" % query.table()
+            sql += sql2.replace("%s", "?")
+            self.sqlcache[key] = sql
         self.execute(sql, values)
         try:
             data = self.cursor.rowcount
@@ -32,35 +32,58 @@ Model classes, for each SQL datatype
 Metaclass, that initalizes each instance of a Model class
 """
 
-import inspect
+import copy
 import pprint
 import datetime
+import hashlib
+
+import basium_common as bc
+
+
+MAX_INDEX_NAME = 63     # postgresql truncates longer names, mysql allows 64
 
 
 class Column:
     """
     Base class for all different column types
+
+    A column is a data descriptor, reading or writing the attribute
+    on a Model instance accesses the value in the instance _values.
+    On the class the attribute is the column itself
     """
 
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        return obj._values[self.name]
+
+    def __set__(self, obj, value):
+        obj._values[self.name] = value
+        obj._dirty.add(self.name)
+
     def getDefault(self):
         return self.default
 
 
 class BooleanCol(Column):
-    def __init__(self, primary_key=False, nullable=True, default=None):
+    def __init__(self, primary_key=False, nullable=True, default=None, index=False, unique=False):
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
 
 class DateCol(Column):
     """
     Stores a date
     """
-    def __init__(self, primary_key=False, nullable=False, default=None):
+    def __init__(self, primary_key=False, nullable=False, default=None, index=False, unique=False):
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     def getDefault(self):
         if self.default == 'NOW':
@@ -74,10 +97,12 @@ class DateTimeCol(Column):
     ignores microseconds
     if default is 'NOW' the current date+time is stored
     """
-    def __init__(self, primary_key=False, nullable=True, default=None):
+    def __init__(self, primary_key=False, nullable=True, default=None, index=False, unique=False):
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     def getDefault(self):
         if self.default == 'NOW':
@@ -90,10 +115,12 @@ class DecimalCol(Column):
     Stores a fixed precision number
     we cheat and represent this as a float in python
     """
-    def __init__(self, primary_key=False, nullable=True, default=None, maxdigits=5, decimal=2):
+    def __init__(self, primary_key=False, nullable=True, default=None, maxdigits=5, decimal=2, index=False, unique=False):
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
         self.maxdigits = maxdigits
         self.decimal = decimal
 
@@ -102,20 +129,24 @@ class FloatCol(Column):
     """
     Stores a floating point number
     """
-    def __init__(self, primary_key=False, nullable=True, default=None):
+    def __init__(self, primary_key=False, nullable=True, default=None, index=False, unique=False):
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
 
 class IntegerCol(Column):
     """
     Stores an integer
     """
-    def __init__(self, primary_key=False, nullable=True, default=None, length=11):
+    def __init__(self, primary_key=False, nullable=True, default=None, length=11, index=False, unique=False):
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
         self.length = length
 
 
@@ -123,13 +154,60 @@ class VarcharCol(Column):
     """
     Stores a string
     """
-    def __init__(self, primary_key=False, nullable=True, default=None, length=255):
+    def __init__(self, primary_key=False, nullable=True, default=None, length=255, index=False, unique=False):
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
         self.length = length
 
 
+class ReferenceCol(Column):
+    """
+    Stores a reference to a row in another table, the _id of that row
+    model is the Model class that is referenced
+    Use Query.join() or Query.prefetch() to load the referenced objects
+    """
+    def __init__(self, model, nullable=True, default=None, index=False, unique=False):
+        self.primary_key = False
+        self.nullable = nullable
+        self.default = default
+        self.index = index
+        self.unique = unique
+        self.length = 11
+        self.model = model
+
+
+class Index:
+    """
+    Index on one or more columns, used for composite indexes
+    Declare them in the model as _indexes = [Index('col1', 'col2')]
+    Single column indexes are declared with index=True or unique=True
+    on the column
+    If name is None, it is '<table>_<columns>_idx'
+    """
+    def __init__(self, *columns, unique=False, name=None):
+        self.columns = list(columns)
+        self.unique = unique
+        self.name = name
+
+    def __repr__(self):
+        return "Index(%s, unique=%s, name=%s)" % (", ".join(self.columns), self.unique, self.name)
+
+
+def indexName(name):
+    """
+    Return name shortened to MAX_INDEX_NAME bytes, a long name is cut and
+    ends with a hash of the full name, so it is still unique
+    """
+    data = name.encode('utf-8')
+    if len(data) <= MAX_INDEX_NAME:
+        return name
+    digest = hashlib.md5(data).hexdigest()[:8]
+    return data[:MAX_INDEX_NAME - 9].decode('utf-8', 'ignore') + '_' + digest
+
+
 class Q:
     pass
 
@@ -137,7 +215,23 @@ class Q:
 class ModelMetaClass(type):
     """
     Metaclass that helps constructing the classes that should be persisted
+
+    The columns, their defaults and the q namespace are found once when
+    the class is created, so creating an instance only needs to allocate
+    the values
+
+    Model classes get an empty __slots__, so instances does not have
+    a __dict__. A class that needs other instance attributes than the
+    columns can define its own __slots__
+
+    The indexes, from the columns and from _indexes in the class, are
+    collected in _indexes with their names filled in
     """
+    def __new__(mcs, name, bases, dct):
+        if '__slots__' not in dct:
+            dct['__slots__'] = ()
+        return super(ModelMetaClass, mcs).__new__(mcs, name, bases, dct)
+
     def __init__(cls, name, bases, dct):
         super(ModelMetaClass, cls).__init__(name, bases, dct)
         cls._primary_key = ['_id']
@@ -145,8 +239,55 @@ class ModelMetaClass(type):
             cls._table = dct["_table"]
         else:
             cls._table = name.lower()
-        cls._columns = {}
-        cls._values = {}
+
+        _id = IntegerCol(primary_key=True)
+        columns = {'_id': _id}
+        for colname in sorted(dir(cls)):
+            column = getattr(cls, colname)
+            if colname[0] != "_" and isinstance(column, Column):
+                if colname not in dct:
+                    # inherited, the subclass needs its own column with a backpointer to it
+                    column = copy.copy(column)
+                    setattr(cls, colname, column)
+                columns[colname] = column
+
+        q = Q()
+        defaults = {}
+        dynamic = []    # columns with a default that is calculated for each instance
+        for colname, column in columns.items():
+            column.name = colname
+            column._model = cls  # backpointer from column to model class
+            setattr(q, colname, column)
+            defaults[colname] = column.default     # also keeps the values in column order
+            if type(column).getDefault is not Column.getDefault:
+                dynamic.append(column)
+
+        if '_indexes' in dct:
+            declared = list(dct['_indexes'])
+        else:
+            declared = list(getattr(cls, '_declaredIndexes', []))
+        indexes = []
+        for colname, column in columns.items():
+            if column.index or column.unique:
+                indexes.append(Index(colname, unique=column.unique))
+        for index in declared:
+            for colname in index.columns:
+                if colname not in columns:
+                    raise bc.Error(1, "Index on unknown column '%s' in class %s" % (colname, name))
+            indexes.append(Index(*index.columns, unique=index.unique, name=index.name))
+        for index in indexes:
+            if index.name is None:
+                index.name = indexName('%s_%s_idx' % (cls._table, '_'.join(index.columns)))
+            elif len(index.name.encode('utf-8')) > MAX_INDEX_NAME:
+                raise bc.Error(1, "Index name '%s' in class %s is longer than %d bytes" % (index.name, name, MAX_INDEX_NAME))
+
+        cls._id = _id
+        cls._columns = columns
+        cls._declaredIndexes = declared
+        cls._indexes = indexes
+        cls._defaults = defaults
+        cls._dynamic = dynamic
+        cls.q = q
 
 
 class Model(metaclass=ModelMetaClass):
@@ -154,39 +295,16 @@ class Model(metaclass=ModelMetaClass):
     Base class for all classes that should be persistable
     """
     __metaclass__ = ModelMetaClass
+    __slots__ = ('_values', '_dirty', '_related')
 
     def __init__(self, id_value=-1):
-        _id = IntegerCol(primary_key=True)
-        _id._model = self
-        _id.name = '_id'
-        columns = {'_id': _id}
-        values = {'_id': id_value}
-
-        # create instance variables of the class columns
-        q = Q()
-        q._id = _id
-        for colname, column in inspect.getmembers(self):
-            if colname[0] != "_" and isinstance(column, Column):
-                column.name = colname
-                column._model = self  # backpointer from column to model class
-                columns[colname] = column
-                values[colname] = column.getDefault()
-                setattr(q, colname, column)
-        object.__setattr__(self, '_columns', columns)
-        object.__setattr__(self, '_values', values)
-        object.__setattr__(self, 'q', q)
-
-    def __setattr__(self, attr, value):
-        if attr in self._columns:
-            self._values[attr] = value
-        else:
-            object.__setattr__(self, attr, value)
-
-    def __getattribute__(self, attr):
-        if attr in object.__getattribute__(self, '_values'):
-            return object.__getattribute__(self, '_values')[attr]
-        else:
-            return object.__getattribute__(self, attr)
+        values = dict(self._defaults)
+        values['_id'] = id_value
+        for column in self._dynamic:
+            values[column.name] = column.getDefault()
+        self._values = values
+        self._dirty = set()     # columns changed since load/store
+        self._related = {}      # objects loaded by Query.join() and Query.prefetch()
 
     def __str__(self):
         return pprint.pformat(self._getValues(), indent=4)
@@ -200,11 +318,19 @@ class Model(metaclass=ModelMetaClass):
                     return False
         return True
 
+    def _getRelated(self, name):
+        """
+        Return related objects, loaded by Query.join() or Query.prefetch()
+        name is the name of the ReferenceCol for the referenced object, or
+        the table name of the referencing objects for a list of them
+        """
+        return self._related.get(name, None)
+
     def _get(self, attr):
-        return self.__getattribute__(attr)
+        return getattr(self, attr)
 
     def _set(self, attr, value):
-        self.__setattr__(attr, value)
+        setattr(self, attr, value)
 
     def _getValues(self):
         """return all columns as a dictionary, data presented in sql format"""
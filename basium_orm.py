@@ -34,8 +34,23 @@ This class handles all mapping between objects and dictionaries,
 before calling database driver, or returning objects
 """
 
+import json
+import time
+import decimal
+import datetime
+import base64
 import inspect
-import urllib
+import urllib.parse
+import threading
+import collections
+import copy
+import array
+import contextlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # optional, only used by loadColumns()
 
 import basium_common as bc
 import basium_model
@@ -48,6 +63,102 @@ EQ = '='
 GT = '>'
 GE = '>='
 NE = '!='
+IN = 'IN'
+NOT_IN = 'NOT IN'
+
+listOperands = [IN, NOT_IN]   # operands that take a list of values
+
+
+def arrayType(column):
+    """
+    Return the array.array typecode used by loadColumns() for the
+    values of a column or Aggregate, None if the values are kept in a list
+    """
+    if isinstance(column, Aggregate):
+        if isinstance(column, Count):
+            return 'q'
+        if isinstance(column, Avg):
+            return 'd'
+        column = column.column
+    if isinstance(column, basium_model.BooleanCol):
+        return 'b'
+    if isinstance(column, basium_model.FloatCol):
+        return 'd'
+    if isinstance(column, (basium_model.IntegerCol, basium_model.ReferenceCol)):
+        return 'q'
+    return None
+
+
+def keysetValue(column, value):
+    """
+    Convert a value from a keyset token or URL back to the python
+    type of the column. The values are sent as JSON, so dates and
+    decimals arrives as strings
+    Raises ValueError if the value cannot be converted
+    """
+    if value is None:
+        return None
+    try:
+        if isinstance(column, basium_model.BooleanCol):
+            if isinstance(value, str):
+                return value == "True"
+            return bool(value)
+        if isinstance(column, basium_model.DateTimeCol):
+            return datetime.datetime.fromisoformat(value)
+        if isinstance(column, basium_model.DateCol):
+            return datetime.date.fromisoformat(value[:10])
+        if isinstance(column, basium_model.DecimalCol):
+            return decimal.Decimal(value)
+        if isinstance(column, basium_model.FloatCol):
+            return float(value)
+        if isinstance(column, (basium_model.IntegerCol, basium_model.ReferenceCol)):
+            return int(value)
+    except (TypeError, decimal.InvalidOperation) as e:
+        raise ValueError(str(e))
+    return value
+
+
+def keysetJson(values):
+    """Return the keyset values as JSON, dates and decimals as strings"""
+    return json.dumps(values, default=str)
+
+
+def needsConversion(column):
+    """
+    Returns True if the values of column from the driver must be
+    converted with toPython()
+    """
+    if column.nativeType:
+        return False
+    return type(column).toPython is not basium_driver.Column.toPython
+
+
+def numpyType(column):
+    """Return the numpy dtype used by loadColumns() for the values of a column or Aggregate"""
+    if isinstance(column, Aggregate) and not isinstance(column, (Count, Avg)):
+        column = column.column
+    typecode = arrayType(column)
+    if typecode == 'b':
+        return numpy.bool_
+    if typecode == 'd':
+        return numpy.float64
+    if typecode == 'q':
+        return numpy.int64
+    if isinstance(column, basium_model.DateTimeCol):
+        return 'datetime64[s]'
+    if isinstance(column, basium_model.DateCol):
+        return 'datetime64[D]'
+    return object
+
+
+def columnSql(column, qualify=False, quote=''):
+    """
+    Return the name of a column for SQL, if qualify is True prefixed
+    with the table name, as needed when tables are joined
+    """
+    if qualify:
+        return '%s.%s%s%s' % (column._model._table, quote, column.name, quote)
+    return '%s%s%s' % (quote, column.name, quote)
 
 
 class BasiumOrm:
@@ -65,6 +176,8 @@ class BasiumOrm:
         """
         self.driver = driver
         self.drivermodule = drivermodule
+        self._hydrators = basium_driver.SqlCache()    # hydrate functions, keyed on the result layout
+        self._txlocal = threading.local()  # objects changed in the open transactions of each thread
 
         drvclasses = {}
         for tmp in inspect.getmembers(self.drivermodule, inspect.isclass):
@@ -140,9 +253,19 @@ class BasiumOrm:
             query = query_
         else:
             raise bc.Error(1, "Fatal: incorrect object type in count")
-        return self.driver.count(query)
-
-    def load(self, query_):
+        queries = query.split(self.driver.maxParams)
+        if len(queries) > 1:
+            return sum([self.count(part) for part in queries])
+        if self.cache is None:
+            return self.driver.count(query)
+        key = ('count', query.table(), query.encode())
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = self.driver.count(query)
+            self.cache.put(key, query.table(), rows)
+        return rows
+
+    def load(self, query_, rows=None):
         """
         Fetch one or multiple rows from table, each stored in a object
         If no query is specified, the default is to fetch one object
@@ -155,11 +278,28 @@ class BasiumOrm:
         Driver returns an object that can be iterated over one row at a time
         or throws DriverError
 
+        If the query is created with Query.values(), plain tuples or
+        dictionaries are returned instead of objects
+
+        rows can be 'tuple', 'dict' or 'namedtuple', then the converted
+        values are returned in that form instead of objects, overriding
+        Query.values(). This is much faster for read-only use. The columns
+        are in the order of the model, in a namedtuple _id is named id
+
+        If the query has more values than the driver can handle in one
+        query, it is split in several queries, see Query.split()
+
         Note: when loading a single object, an error is returned if not found. 
         Workaround is to use a query instead
         """
+        if rows not in (None, 'tuple', 'dict', 'namedtuple'):
+            raise bc.Error(1, "Unknown rows %s in load()" % rows)
         one = False
         if isinstance(query_, basium_model.Model):
+            if self.session is not None and rows is None:
+                obj = self.session.get(query_._table, query_._id)
+                if obj is not None:
+                    return [obj]
             query = Query().filter(query_.q._id, EQ, query_._id)
             one = True
         elif isinstance(query_, Query):
@@ -167,18 +307,436 @@ class BasiumOrm:
         else:
             raise bc.Error(1, "Fatal: incorrect object type")
 
+        queries = query.split(self.driver.maxParams)
+        if len(queries) > 1:
+            data = []
+            for part in queries:
+                data.extend(self.load(part, rows))
+            query.sortRows(data, rows)
+            return data
+
+        data = None
+        rowtype = query._rowtype
+        if rows is not None:
+            rowtype = rows
+        # related objects are not cached, changes in their tables does not invalidate
+        cache = self.cache
+        if len(query._join) > 0 or len(query._prefetch) > 0:
+            cache = None
+        if cache is not None:
+            key = ('load', query.table(), query.encode(), rows)
+            cached = cache.get(key)
+            if cached is not None:
+                if rowtype is None:
+                    data = []
+                    for values in cached:
+                        newobj = query._model()
+                        newobj._values.update(values)
+                        data.append(newobj)
+                elif rowtype == 'dict':
+                    data = [dict(row) for row in cached]
+                else:
+                    data = list(cached)
+        if data is None:
+            cursor = self.driver.select(query)
+            hydrate = self._queryHydrator(query, cursor.description, rowtype)
+            data = [hydrate(row) for row in cursor]
+            if rowtype is None and len(query._prefetch) > 0:
+                self._prefetchRelated(query, data)
+            if cache is not None:
+                if rowtype is None:
+                    cache.put(key, query.table(), [dict(obj._values) for obj in data])
+                elif rowtype == 'dict':
+                    cache.put(key, query.table(), [dict(row) for row in data])
+                else:
+                    cache.put(key, query.table(), list(data))
+        if one:
+            if len(data) < 1:
+                raise bc.Error(1, "Unknown ID %s in table %s" % (query_._id, query_._table))
+            if self.session is not None and rows is None:
+                self.session.add(data[0])
+
+        return data
+
+    def loadMany(self, cls, ids):
+        """
+        Load the objects of class cls with _id in ids, using one query
+        (or a few, if there are more ids than the driver can handle)
+        Returns a list in the same order as ids, ids that are not
+        found are left out
+        """
+        obj = cls()
+        found = {}
+        if self.session is not None:
+            for _id in ids:
+                tmp = self.session.get(obj._table, _id)
+                if tmp is not None:
+                    found[_id] = tmp
+        missing = [_id for _id in ids if _id not in found]
+        if len(missing) > 0:
+            for tmp in self.load(Query(obj, log=self.log).filter(obj.q._id, IN, missing)):
+                found[tmp._id] = tmp
+                if self.session is not None:
+                    self.session.add(tmp)
+        return [found[_id] for _id in ids if _id in found]
+
+    def iterLoad(self, query_, batchsize=None, rows=None):
+        """
+        Fetch one or multiple rows from table, same as load() but
+        returns a generator that yields one object at a time
+        rows is the same as for load()
+
+        Rows are fetched from the database batchsize rows at a time,
+        default is dbconf.batchsize. If dbconf.serverCursor is set the
+        result is kept in the database server, so memory usage is bounded
+        also for very large results.
+        Each call uses its own cursor, it is safe to do other queries
+        while iterating, except with mysql and dbconf.serverCursor
+        Query.prefetch() is not done, use Query.join() instead
+
+        Query can be either
+            An instance of Model()
+            An instance of Query()
+        """
+        if isinstance(query_, basium_model.Model):
+            query = Query().filter(query_.q._id, EQ, query_._id)
+        elif isinstance(query_, Query):
+            query = query_
+        else:
+            raise bc.Error(1, "Fatal: incorrect object type")
+
+        if batchsize is None:
+            batchsize = 1000
+            if self.dbconf is not None:
+                batchsize = self.dbconf.batchsize
+        cursor = self.driver.select(query, stream=True)
+        hydrate = None
+        for row in self.driver.fetchIter(cursor, batchsize):
+            if hydrate is None:
+                # a server side cursor has no description until the first fetch
+                hydrate = self._queryHydrator(query, cursor.description, rows)
+            yield hydrate(row)
+
+    def loadColumns(self, query_, batchsize=None):
+        """
+        Fetch rows like load(), but return the result column by column
+        as a dictionary, column name -> values. No objects are created
+
+        With NumPy installed the values are numpy arrays, with a dtype
+        from the column type. Without NumPy the values of boolean, integer
+        and float columns are array.array, other columns are lists.
+        An integer, float or boolean column with NULL values is returned as
+        a list, or a numpy array with dtype object
+
+        Query.values() selects the columns, default is all columns. Grouped
+        queries returns the group columns and the aggregates
+        Query.join() is not supported
+        """
+        if isinstance(query_, basium_model.Model):
+            query = Query().filter(query_.q._id, EQ, query_._id)
+        elif isinstance(query_, Query):
+            query = query_
+        else:
+            raise bc.Error(1, "Fatal: incorrect object type")
+        if len(query._join) > 0:
+            raise bc.Error(1, "loadColumns() cannot be used with join()")
+
+        if batchsize is None:
+            batchsize = 1000
+            if self.dbconf is not None:
+                batchsize = self.dbconf.batchsize
+        select = query.columnNames()
+        if select is None:
+            select = list(query._model._columns.keys())
+        sources = dict(query._aggregate)
+        for colname in select:
+            if colname not in sources:
+                sources[colname] = query._model._columns[colname]
         data = []
-        for row in self.driver.select(query):
-            newobj = query._model.__class__()
-            for colname, column in newobj._iterNameColumn():
+        for colname in select:
+            typecode = arrayType(sources[colname])
+            if typecode is None:
+                data.append([])
+            else:
+                data.append(array.array(typecode))
+
+        cursor = self.driver.select(query, stream=True)
+        plan = None
+        for row in self.driver.fetchIter(cursor, batchsize):
+            if plan is None:
+                # a server side cursor has no description until the first fetch
+                names = [d[0] for d in cursor.description]
+                plan = []
+                for colname in select:
+                    source = sources[colname]
+                    if isinstance(source, Aggregate) or needsConversion(source):
+                        plan.append((names.index(colname), source.toPython))
+                    else:
+                        plan.append((names.index(colname), None))
+            try:
+                for i, (ix, toPython) in enumerate(plan):
+                    value = row[ix]
+                    if toPython is not None:
+                        if value is None or value == 'NULL':
+                            value = None
+                        else:
+                            value = toPython(value)
+                    try:
+                        data[i].append(value)
+                    except TypeError:
+                        # NULL, or a value that does not fit in the array
+                        data[i] = list(data[i])
+                        data[i].append(value)
+            except ValueError as e:
+                raise bc.Error(1, "Cannot convert value in table %s, %s" % (query.table(), e))
+
+        result = {}
+        for colname, values in zip(select, data):
+            if numpy is not None:
+                if isinstance(values, list):
+                    dtype = numpyType(sources[colname])
+                    if dtype not in ['datetime64[s]', 'datetime64[D]']:
+                        dtype = object
+                    tmp = numpy.empty(len(values), dtype=dtype)
+                    tmp[:] = values
+                    values = tmp
+                else:
+                    values = numpy.array(values, dtype=numpyType(sources[colname]))
+            result[colname] = values
+        return result
+
+    def _queryHydrator(self, query, description, rowtype=None):
+        """
+        Return a function that creates the result of query from a row,
+        with the objects from joined tables attached
+        rowtype overrides the row type of the query
+        """
+        if rowtype is None:
+            rowtype = query._rowtype
+        joined = None
+        if rowtype is not None and len(query._join) > 0:
+            # plain rows, the joined columns are converted with the referenced models columns
+            joined = {}
+            for join in query._join:
+                for colname, column in join.model._columns.items():
+                    joined[join.prefix() + colname] = column
+        hydrate = self._hydrator(query._model, description, rowtype, query.columnNames(), query._aggregate, joined)
+        if len(query._join) == 0 or rowtype is not None:
+            return hydrate
+
+        # the joined columns are named <prefix><column>, strip prefix
+        names = [d[0] for d in description]
+        joins = []
+        for join in query._join:
+            prefix = join.prefix()
+            joindescription = []
+            for name in names:
+                if name.startswith(prefix):
+                    joindescription.append((name[len(prefix):],))
+                else:
+                    joindescription.append((None,))
+            joins.append((join.column.name, self._hydrator(join.model, joindescription)))
+
+        def hydrateJoin(row):
+            obj = hydrate(row)
+            for colname, hydrateRef in joins:
+                ref = hydrateRef(row)
+                if ref._id is None:
+                    ref = None      # no referenced row
+                obj._related[colname] = ref
+            return obj
+        return hydrateJoin
+
+    def _prefetchRelated(self, query, data):
+        """
+        Load the related objects for Query.prefetch(), with one query
+        for each relation, and attach them to the loaded objects
+        """
+        if len(data) == 0:
+            return
+        for column in query._prefetch:
+            if column._model._table == query.table():
+                # the loaded objects references other objects
+                ids = set([obj._values[column.name] for obj in data]) - set([None])
+                related = {}
+                if len(ids) > 0:
+                    ref = column.model()
+                    for refobj in self.load(Query(ref, log=self.log).filter(ref.q._id, IN, sorted(ids))):
+                        related[refobj._id] = refobj
+                for obj in data:
+                    obj._related[column.name] = related.get(obj._values[column.name], None)
+            else:
+                # other objects references the loaded objects
+                ref = column._model()
+                related = {}
+                query2 = Query(ref, log=self.log).filter(ref._columns[column.name], IN, [obj._id for obj in data])
+                for refobj in self.load(query2.order(ref.q._id)):
+                    related.setdefault(refobj._values[column.name], []).append(refobj)
+                for obj in data:
+                    obj._related[ref._table] = related.get(obj._id, [])
+
+    def _hydrator(self, cls, description, rowtype=None, select=None, aggregates=None, joined=None):
+        """
+        Return a function that creates an object of class cls from a row
+        returned by the driver.
+
+        The function is created once for each model class and layout of
+        the result, the column position in the row is looked up from the
+        cursor description. toPython() is only called for columns where the
+        driver has a conversion, other values are copied as they are, see
+        needsConversion(). NULL values are always None
+
+        If rowtype is 'tuple', 'dict' or 'namedtuple' the function instead
+        returns the converted values of the columns in select, default all
+        columns of cls, as a tuple, dictionary or namedtuple.
+        aggregates is a list of (name, Aggregate) for columns in select
+        that are calculated by the database, joined is a dictionary with
+        the columns from joined tables in select
+        """
+        names = tuple([d[0] for d in description])
+        if select is not None:
+            select = tuple(select)
+        if aggregates is None:
+            aggregates = []
+        key = (cls, names, rowtype, select,
+               tuple([(name, aggregate.func, aggregate.colname()) for name, aggregate in aggregates]),
+               None if joined is None else tuple(joined.keys()))
+        try:
+            return self._hydrators[key]
+        except KeyError:
+            pass
+
+        columns = cls._columns
+        if rowtype is not None:
+            if select is None:
+                select = [colname for colname in columns if colname in names]
+            plan = []
+            aggregates = dict(aggregates)
+            for colname in select:
+                if colname in aggregates:
+                    plan.append((colname, names.index(colname), aggregates[colname].toPython))
+                    continue
+                if colname in columns:
+                    column = columns[colname]
+                else:
+                    column = joined[colname]
+                if not needsConversion(column):
+                    plan.append((colname, names.index(colname), None))
+                else:
+                    plan.append((colname, names.index(colname), column.toPython))
+
+            def convert(row):
+                values = []
                 try:
-                    newobj._values[colname] = column.toPython(row[colname])
-                except (KeyError, ValueError):
-                    pass
-            data.append(newobj)
-        if one and len(data) < 1:
-            raise bc.Error(1, "Unknown ID %s in table %s" % (query_._id, query_._table))
+                    for colname, ix, toPython in plan:
+                        value = row[ix]
+                        if toPython is None:
+                            values.append(value)
+                        elif value is None or value == 'NULL':
+                            values.append(None)
+                        else:
+                            values.append(toPython(value))
+                except ValueError as e:
+                    raise bc.Error(1, "Cannot convert value in table %s, %s" % (cls._table, e))
+                return values
+
+            if rowtype == 'dict':
+                colnames = [colname for colname, ix, toPython in plan]
+
+                def hydrate(row):
+                    return dict(zip(colnames, convert(row)))
+            elif rowtype == 'namedtuple':
+                fields = ['id' if colname == '_id' else colname for colname, ix, toPython in plan]
+                rowcls = collections.namedtuple('%sRow' % cls.__name__, fields, rename=True)
+
+                def hydrate(row):
+                    return rowcls._make(convert(row))
+            else:
+                def hydrate(row):
+                    return tuple(convert(row))
+            self._hydrators[key] = hydrate
+            return hydrate
+
+        direct = []         # values used as they are
+        conversions = []    # values converted with toPython()
+        for ix, colname in enumerate(names):
+            if colname not in columns:
+                continue
+            column = columns[colname]
+            if not needsConversion(column):
+                direct.append((colname, ix))
+            else:
+                conversions.append((colname, ix, column.toPython))
+
+        def hydrate(row):
+            newobj = cls()
+            values = newobj._values
+            for colname, ix in direct:
+                values[colname] = row[ix]
+            try:
+                for colname, ix, toPython in conversions:
+                    value = row[ix]
+                    if value is None or value == 'NULL':
+                        values[colname] = None
+                    else:
+                        values[colname] = toPython(value)
+            except ValueError as e:
+                raise bc.Error(1, "Cannot convert value in table %s, %s" % (cls._table, e))
+            return newobj
 
+        self._hydrators[key] = hydrate
+        return hydrate
+
+    def first(self, query):
+        """
+        Return the first object matching the query, or None if
+        there is no match. Only one row is fetched from the database
+        """
+        if not isinstance(query, Query):
+            raise bc.Error(1, "Fatal: incorrect object type")
+        data = self.load(query.limitOne())
+        if len(data) == 0:
+            return None
+        return data[0]
+
+    def get(self, query):
+        """
+        Return the object matching the query, same as first() but
+        an error is raised if there is no match
+        """
+        if not isinstance(query, Query):
+            raise bc.Error(1, "Fatal: incorrect object type")
+        if self.session is not None and query.isId():
+            obj = self.session.get(query.table(), query._where[0].value)
+            if obj is not None:
+                return obj
+        obj = self.first(query)
+        if obj is None:
+            raise bc.Error(1, "No row in table %s matching query" % query.table())
+        return obj
+
+    def exists(self, query):
+        """
+        Return True if at least one row matches the query
+        The database stops at the first matching row, use this
+        instead of count() to check if there is any row
+        """
+        if not isinstance(query, Query):
+            raise bc.Error(1, "Fatal: incorrect object type")
+        queries = query.split(self.driver.maxParams)
+        if len(queries) > 1:
+            for part in queries:
+                if self.exists(part):
+                    return True
+            return False
+        query = query.limitOne(exists=True)
+        if self.cache is None:
+            return self.driver.exists(query)
+        key = ('exists', query.table(), query.encode())
+        data = self.cache.get(key)
+        if data is None:
+            data = self.driver.exists(query)
+            self.cache.put(key, query.table(), data)
         return data
 
     def store(self, obj):
@@ -186,20 +744,69 @@ class BasiumOrm:
         Store the query in the database
         If the objects _id is set, we update the current row in the table,
         otherwise we create a new row
-        """
-        columns = {}
-        for colname, column in obj._iterNameColumn():
-            columns[colname] = column.toSql(obj._values[colname])
 
+        An update only writes the columns that has been changed since
+        the object was loaded or last stored, if there are no changes
+        nothing is sent to the database
+        """
+        self._remember(obj)
         if obj._id >= 0:
             # update
-            # data = self.driver.update(obj._table, columns)
-            self.driver.update(obj._table, columns)
+            columns = {}
+            for colname in obj._dirty:
+                if colname != '_id':
+                    columns[colname] = obj._columns[colname].toSql(obj._values[colname])
+            if len(columns) > 0:
+                columns['_id'] = obj._columns['_id'].toSql(obj._id)
+                self.driver.update(obj._table, columns)
         else:
             # insert
+            columns = {}
+            for colname, column in obj._iterNameColumn():
+                columns[colname] = column.toSql(obj._values[colname])
             obj._id = self.driver.insert(obj._table, columns)
+        obj._dirty.clear()
+        if self.session is not None:
+            self.session.add(obj)
+        if self.cache is not None:
+            self.cache.invalidate(obj._table)
         return obj._id
 
+    def storeMany(self, objs, chunksize=500):
+        """
+        Store multiple objects in the database
+        New objects are grouped by table and inserted chunksize rows at
+        a time, objects that already have an _id are updated one by one
+        Returns a list with the _id of each object, in the same order as objs
+        """
+        tables = {}
+        for obj in objs:
+            if obj._id >= 0:
+                self.store(obj)
+                continue
+            self._remember(obj)
+            columns = {}
+            for colname, column in obj._iterNameColumn():
+                columns[colname] = column.toSql(obj._values[colname])
+            if obj._table not in tables:
+                tables[obj._table] = []
+            tables[obj._table].append((obj, columns))
+
+        for table, rows in tables.items():
+            for start in range(0, len(rows), chunksize):
+                chunk = rows[start:start + chunksize]
+                ids = self.driver.insertMany(table, [columns for obj, columns in chunk])
+                if len(ids) != len(chunk):
+                    raise bc.Error(1, "Expected %i ids from insert in table %s, got %i" % (len(chunk), table, len(ids)))
+                for (obj, columns), _id in zip(chunk, ids):
+                    obj._id = _id
+                    obj._dirty.clear()
+                    if self.session is not None:
+                        self.session.add(obj)
+            if self.cache is not None:
+                self.cache.invalidate(table)
+        return [obj._id for obj in objs]
+
     def delete(self, query_):
         """
         Delete objects in the table.
@@ -214,53 +821,431 @@ class BasiumOrm:
         if isinstance(query_, basium_model.Model):
             query = Query().filter(query_.q._id, EQ, query_._id)
             one = True
+            self._remember(query_)
         elif isinstance(query_, Query):
             query = query_
         else:
             raise bc.Error(1, "Fatal: incorrect object type passed")
-        rowcount = self.driver.delete(query)
+        if len(query._join) > 0:
+            raise bc.Error(1, "delete() with Query.join() not implemented")
+        rowcount = 0
+        for part in query.split(self.driver.maxParams):
+            rowcount += self.driver.delete(part)
+        if self.cache is not None:
+            self.cache.invalidate(query.table())
+        if self.session is not None:
+            if one:
+                self.session.remove(query_._table, query_._id)
+            else:
+                self.session.removeTable(query.table())
         if one:
             query_._id = -1
         return rowcount
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager, the statements inside are committed once at the
+        end, or rolled back if there is an exception
+
+            with db.transaction():
+                db.store(obj1)
+                db.store(obj2)
+
+        Transactions can be nested, an inner transaction is a savepoint
+        With the JSON driver each statement is still committed by the server
+
+        Objects stored or deleted in a transaction that is rolled back get
+        back their _id and changed columns, so they can be stored again
+        """
+        self.driver.begin()
+        stack = getattr(self._txlocal, 'stack', None)
+        if stack is None:
+            stack = []
+            self._txlocal.stack = stack
+        stack.append({})    # id(obj) -> (obj, _id, _dirty) before the first change
+        try:
+            yield self
+        except BaseException:
+            saved = stack.pop()
+            self.driver.rollback()
+            for obj, _id, dirty in saved.values():
+                obj._id = _id
+                obj._dirty = dirty
+            # the cache and session may have data that was rolled back
+            if self.cache is not None:
+                self.cache.clear()
+            if self.session is not None:
+                self.session.clear()
+            raise
+        saved = stack.pop()
+        self.driver.commit()
+        if len(stack) > 0:
+            # the outer transaction can still be rolled back
+            for key, state in saved.items():
+                stack[-1].setdefault(key, state)
+
+    def _remember(self, obj):
+        """
+        Save _id and the changed columns of obj the first time it is
+        stored or deleted in the innermost open transaction, so they
+        can be restored if the transaction is rolled back
+        """
+        stack = getattr(self._txlocal, 'stack', None)
+        if stack:
+            saved = stack[-1]
+            if id(obj) not in saved:
+                saved[id(obj)] = (obj, obj._id, set(obj._dirty))
+
+    def poolStats(self):
+        """
+        Returns statistics from the drivers connection pool, wait times
+        and utilization, or None if the driver does not use a pool
+        """
+        return self.driver.poolStats()
+
+    def startSession(self):
+        """
+        Start using an identity map, so repeated load() of the same
+        object by _id returns the cached object without a database query
+        Returns the session
+        """
+        self.session = Session()
+        return self.session
+
+    def endSession(self):
+        """
+        Stop using the identity map, all cached objects are dropped
+        """
+        self.session = None
+
     def query(self, obj=None):
         """
         Create and return a query object. This is a convenience method,
         makes it unnecessary to import the basium_orm module
         just for doing queries
         """
-        q = Query(obj)
+        q = Query(obj, log=self.log, db=self)
         return q
 
 
+class Session:
+    """
+    Identity map, keeps one object for each (table, _id)
+
+    Objects are added when loaded by _id or stored, and removed when
+    deleted. Use clear() to drop all objects, for example at the
+    end of each HTTP request
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, table, _id):
+        return self.objects.get((table, _id), None)
+
+    def add(self, obj):
+        self.objects[(obj._table, obj._id)] = obj
+
+    def remove(self, table, _id):
+        self.objects.pop((table, _id), None)
+
+    def removeTable(self, table):
+        for key in [key for key in self.objects if key[0] == table]:
+            del self.objects[key]
+
+    def clear(self):
+        self.objects = {}
+
+
+class QueryCache:
+    """
+    Read-through cache for the results of load() and count()
+
+    Results are keyed on the table and the encoded query, at most
+    maxsize results are kept, the least recently used is evicted first.
+    A result older than ttl seconds is not used.
+    All results for a table are invalidated when an object is stored
+    or deleted in that table, through this Basium instance
+    """
+
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = collections.OrderedDict()   # key -> (expire time, table, data)
+            self.tables = {}                           # table -> set of keys
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expired = 0
+            self.invalidations = 0
+
+    def _remove(self, key):
+        expire, table, data = self.entries.pop(key)
+        self.tables[table].discard(key)
+
+    def get(self, key):
+        """
+        Returns cached data, or None if not in cache or expired
+        """
+        with self.lock:
+            try:
+                expire, table, data = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expire < time.monotonic():
+                self._remove(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, table, data):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, table, data)
+            if table not in self.tables:
+                self.tables[table] = set()
+            self.tables[table].add(key)
+            while len(self.entries) > self.maxsize:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, table):
+        """Remove all cached results for the table"""
+        with self.lock:
+            for key in list(self.tables.get(table, [])):
+                self._remove(key)
+                self.invalidations += 1
+
+    def stats(self):
+        """Return counters, to check if the cache is useful"""
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "expired": self.expired,
+                    "invalidations": self.invalidations}
+
+
+class Q:
+    """
+    Filter expression, that can be combined with | (OR), & (AND) and ~ (NOT)
+    to a single WHERE clause, for example
+        query.filter(Q(obj.q.a, EQ, 1) | Q(obj.q.b, GT, 2) & ~Q(obj.q.c, IN, [3, 4]))
+    Arguments are the same as for Query.filter()
+    """
+
+    def __init__(self, column=None, operand=None, value=None):
+        self.op = None          # None for a single condition, else 'AND', 'OR' or 'NOT'
+        self.children = []
+        self.where = None
+        if column is not None:
+            self.where = Query._Where(column=column, operand=operand, value=value)
+
+    def _combine(self, other, op):
+        if not isinstance(other, Q):
+            return NotImplemented
+        q = Q()
+        q.op = op
+        for tmp in [self, other]:
+            if tmp.op == op:
+                q.children.extend(tmp.children)
+            else:
+                q.children.append(tmp)
+        return q
+
+    def __and__(self, other):
+        return self._combine(other, 'AND')
+
+    def __or__(self, other):
+        return self._combine(other, 'OR')
+
+    def __invert__(self):
+        q = Q()
+        q.op = 'NOT'
+        q.children = [self]
+        return q
+
+    def wheres(self):
+        """Return all conditions in the expression"""
+        if self.op is None:
+            return [self.where]
+        res = []
+        for child in self.children:
+            res.extend(child.wheres())
+        return res
+
+    def isList(self):
+        return False
+
+    def paramCount(self):
+        return sum([where.paramCount() for where in self.wheres()])
+
+    def toSql(self, qualify=False):
+        return (self.condition(qualify), self.sqlValues())
+
+    def condition(self, qualify=False):
+        """Return the SQL text for the expression"""
+        if self.op is None:
+            return self.where.condition(qualify)
+        if self.op == 'NOT':
+            return 'NOT (%s)' % self.children[0].condition(qualify)
+        return '(%s)' % (' %s ' % self.op).join([child.condition(qualify) for child in self.children])
+
+    def sqlValues(self):
+        values = []
+        for where in self.wheres():
+            values.extend(where.sqlValues())
+        return values
+
+    def shape(self):
+        if self.op is None:
+            return self.where.shape()
+        return (self.op, tuple([child.shape() for child in self.children]))
+
+    def toList(self, table):
+        """Return the expression as nested lists, for JSON"""
+        if self.op is None:
+            name = self.where.column.name
+            if self.where.column._model._table != table:
+                name = '%s.%s' % (self.where.column._model._table, name)
+            value = self.where.value
+            if self.where.isList():
+                value = [str(v) for v in value]
+            else:
+                value = str(value)
+            return ['W', name, self.where.operand, value]
+        return [self.op] + [child.toList(table) for child in self.children]
+
+    def fromList(self, query, data):
+        """Set the expression from nested lists, as returned by toList()"""
+        if data[0] == 'W':
+            self.where = Query._Where(query._decodeColumn(data[1]), data[2], data[3])
+            return
+        if data[0] not in ['AND', 'OR', 'NOT']:
+            raise ValueError('Unknown operator %s' % data[0])
+        self.op = data[0]
+        for tmp in data[1:]:
+            child = Q()
+            child.fromList(query, tmp)
+            self.children.append(child)
+
+    def encode(self, table):
+        return "x=" + urllib.parse.quote(json.dumps(self.toList(table)))
+
+    def decode(self, query, value):
+        self.fromList(query, json.loads(value))
+
+
+class Aggregate:
+    """
+    Base class for aggregate functions, used with Query.aggregate()
+    column is the column to aggregate, None means all rows
+    """
+    func = None
+
+    def __init__(self, column=None):
+        self.column = column
+
+    def colname(self):
+        if self.column is None:
+            return None
+        return self.column.name
+
+    def toSql(self, quote='', qualify=False):
+        if self.column is None:
+            return '%s(*)' % self.func
+        return '%s(%s)' % (self.func, columnSql(self.column, qualify, quote))
+
+    def toPython(self, value):
+        if value is None or self.column is None:
+            return value
+        return self.column.toPython(value)
+
+
+class Count(Aggregate):
+    """Number of rows, or number of non NULL values in column"""
+    func = 'COUNT'
+
+    def toPython(self, value):
+        return int(value)
+
+
+class Sum(Aggregate):
+    func = 'SUM'
+
+
+class Min(Aggregate):
+    func = 'MIN'
+
+
+class Max(Aggregate):
+    func = 'MAX'
+
+
+class Avg(Aggregate):
+    """Average value of column, always returned as a float"""
+    func = 'AVG'
+
+    def toPython(self, value):
+        if value is None:
+            return value
+        return float(value)
+
+
+aggregates = {}
+for _cls in [Count, Sum, Min, Max, Avg]:
+    aggregates[_cls.func] = _cls
+
+
 class Query():
     """
     Class that build queries
     """
 
-    def __init__(self, model=None, log=None):
-        self._model = model
+    _sqlcache = basium_driver.SqlCache()  # query shape -> compiled SQL, shared by all queries
+
+    def __init__(self, model=None, log=None, db=None):
+        self._model = None  # the queried Model class
         self.log = log
+        self._db = db       # Basium instance, used by first(), exists() and get()
 
         self._table = None
         if model:
             if not isinstance(model, basium_model.Model):
                 self.log.error('Fatal: Query() called with a non-Model object')
                 return
+            self._model = model.__class__
             self._table = model._table
         self._reset()
 
     def _reset(self):
         self._where = []
         self._group = []
+        self._aggregate = []   # list of (name, Aggregate)
         self._order = []
         self._limit = None
+        self._select = None    # list of column names, None is all columns
+        self._rowtype = None   # None returns objects, 'tuple' or 'dict' returns plain rows
+        self._after = None     # keyset pagination, values of the order columns
+        self._join = []        # list of _Join, tables loaded in the same query
+        self._prefetch = []    # list of ReferenceCol, related objects loaded with an extra query
 
     def isId(self):
-        if len(self._where) != 1:
+        if len(self._where) != 1 or len(self._join) > 0:
             return False
         w = self._where[0]
-        return w.column.name == '_id' and w.operand == '='
+        if not isinstance(w, self._Where):
+            return False
+        return w.column.name == '_id' and w.operand == '=' and w.column._model._table == self._table
 
     def table(self):
         return self._table
@@ -271,64 +1256,143 @@ class Query():
             self.operand = operand
             self.value = value
 
-        def toSql(self):
-            sql = '%s %s %%s' % (self.column.name, self.operand)
-            value = self.column.toSql(self.value)
-            return (sql, value)
-
-        def encode(self):
-            return "w=" + urllib.parse.quote("%s,%s,%s" % (self.column.name, self.operand, self.value), ',:=' )
-
-        def decode(self, obj, value):
-            column, self.operand, self.value = value.split(',')
-            self.column = obj._columns[column]
+        def isList(self):
+            return isinstance(self.value, (list, tuple))
+
+        def listSize(self):
+            """
+            Number of placeholders for an IN list, the length rounded up
+            to a power of two, so there are few different shapes.
+            The list is padded with its last value, which gives the same rows
+            """
+            if len(self.value) == 0:
+                return 0
+            return 1 << (len(self.value) - 1).bit_length()
+
+        def toSql(self, qualify=False):
+            return (self.condition(qualify), self.sqlValues())
+
+        def condition(self, qualify=False):
+            name = columnSql(self.column, qualify)
+            if self.isList():
+                if len(self.value) == 0:
+                    # empty list is not valid SQL
+                    if self.operand == NOT_IN:
+                        return '1 = 1'
+                    return '1 = 0'
+                return '%s %s (%s)' % (name, self.operand, ",".join(["%s"] * self.listSize()))
+            return '%s %s %%s' % (name, self.operand)
+
+        def sqlValues(self):
+            if self.isList():
+                values = [self.column.toSql(value) for value in self.value]
+                if len(values) > 0:
+                    values.extend([values[-1]] * (self.listSize() - len(values)))
+                return values
+            return [self.column.toSql(self.value)]
+
+        def paramCount(self):
+            if self.isList():
+                return self.listSize()
+            return 1
+
+        def shape(self):
+            count = None
+            if self.isList():
+                count = self.listSize()
+            return (self.column._model._table, self.column.name, self.operand, count)
+
+        def encode(self, table):
+            name = self.column.name
+            if self.column._model._table != table:
+                name = '%s.%s' % (self.column._model._table, name)
+            value = self.value
+            if self.isList():
+                value = json.dumps([str(v) for v in value])
+            return "w=" + urllib.parse.quote("%s,%s,%s" % (name, self.operand, value), ',:=' )
+
+        def decode(self, query, value):
+            column, self.operand, self.value = value.split(',', 2)
+            self.column = query._decodeColumn(column)
+            if self.operand in listOperands:
+                self.value = json.loads(self.value)
 
     class _Group:
-        def __init__(self):
-            pass
+        def __init__(self, column=None):
+            self.column = column
 
-        def toSql(self):
-            return None
+        def toSql(self, qualify=False):
+            return columnSql(self.column, qualify)
 
         def encode(self):
-            return None
+            return "g=" + urllib.parse.quote(self.column.name)
 
         def decode(self, obj, value):
-            return None
+            self.column = obj._columns[value]
 
     class _Order:
         def __init__(self, column=None, desc=False):
             self.column = column
             self.desc = desc
 
-        def toSql(self):
-            sql = '%s' % (self.column.name)
+        def toSql(self, qualify=False):
+            sql = columnSql(self.column, qualify)
             if self.desc:
                 sql += ' DESC'
             return sql
 
-        def encode(self):
-            return "o=" + urllib.parse.quote("%s,%s" % (self.column.name, self.desc ))
+        def encode(self, table):
+            name = self.column.name
+            if self.column._model._table != table:
+                name = '%s.%s' % (self.column._model._table, name)
+            return "o=" + urllib.parse.quote("%s,%s" % (name, self.desc ))
 
-        def decode(self, obj, value):
+        def decode(self, query, value):
             tmp = value.split(',')
             if len(tmp) < 1 or len(tmp) > 2:
                 return
             column = tmp[0]
-            self.column = obj._columns[column]
+            self.column = query._decodeColumn(column)
             if len(tmp) == 2:
                 self.desc = tmp[1] == 'True'
 
+    class _Join:
+        def __init__(self, column=None):
+            self.column = column    # ReferenceCol in the queried table
+            self.model = None       # the referenced model class
+            if column is not None:
+                self.model = column.model
+
+        def table(self):
+            return self.model._table
+
+        def prefix(self):
+            """Prefix for the names of the joined columns in the result"""
+            return self.column.name + '__'
+
+        def toSql(self):
+            return ' LEFT JOIN %s ON %s._id = %s' % (self.table(), self.table(), columnSql(self.column, True))
+
+        def encode(self):
+            return "j=" + urllib.parse.quote(self.column.name)
+
+        def decode(self, obj, value):
+            self.column = obj._columns[value]
+            self.model = self.column.model
+
     class _Limit:
         def __init__(self, offset=None, rowcount=None):
             self.offset = offset
             self.rowcount = rowcount
 
         def toSql(self):
+            return ' LIMIT %s OFFSET %s'
+
+        def sqlValues(self):
             offset = 0
             if self.offset is not None:
                 offset = self.offset
-            return ' LIMIT %i OFFSET %i' % (self.rowcount, offset)
+            return [int(self.rowcount), int(offset)]
 
         def encode(self):
             return "l=" + urllib.parse.quote("%s,%s" % (self.offset, self.rowcount))
@@ -346,24 +1410,220 @@ class Query():
             else:
                 self.rowcount = None
 
-    def filter(self, column, operand, value):
-        """Add a filter. Returns self so it can be chained"""
+    def filter(self, column, operand=None, value=None):
+        """
+        Add a filter. With operand IN or NOT_IN value is a list
+        column can also be a Q expression, then operand and value are not used
+        All filters must match, use Q for OR and NOT.
+        Returns self so it can be chained
+        """
+        if isinstance(column, Q):
+            for where in column.wheres():
+                if not self._checkFilter(where.column, where.operand, where.value):
+                    return None
+            self._where.append(column)
+            return self
+        if not self._checkFilter(column, operand, value):
+            return None
+        self._where.append(self._Where(column=column, operand=operand, value=value))
+        return self
+
+    def _checkFilter(self, column, operand, value):
         if not isinstance(column, basium_model.Column):
             self.log.error('Query.filter() called with a non-Column %s' % column)
-            return None
+            return False
+        if (operand in listOperands) != isinstance(value, (list, tuple)):
+            self.log.error('Query.filter() operand %s called with incorrect value %s' % (operand, value))
+            return False
         if self._model is None:
             self._model = column._model
             self._table = column._model._table
-        elif self._table != column._model._table:
-            self.log.error('Filter from multiple tables not implemented')
+        elif self._table != column._model._table and not self._isJoined(column._model._table):
+            self.log.error('Filter from multiple tables needs Query.join()')
+            return False
+        return True
+
+    def join(self, column):
+        """
+        Load the object referenced by column, a ReferenceCol, in the
+        same query with a LEFT JOIN. The referenced object is available
+        as obj._getRelated(column name), None if there is no reference.
+        Columns from the joined table can then be used in filter() and
+        order(). Returns self so it can be chained
+        """
+        if not isinstance(column, basium_model.ReferenceCol):
+            self.log.error('Query.join() called with a non-ReferenceCol %s' % column)
             return None
-        self._where.append(self._Where(column=column, operand=operand, value=value))
+        if not self._checkColumns([column], 'join'):
+            return None
+        join = self._Join(column)
+        if join.table() == self._table or self._isJoined(join.table()):
+            self.log.error('Query.join() can only join each table once')
+            return None
+        self._join.append(join)
+        return self
+
+    def _isJoined(self, table):
+        for join in self._join:
+            if join.table() == table:
+                return True
+        return False
+
+    def _decodeColumn(self, name):
+        """
+        Return the column for a name in an encoded query,
+        table.column for columns in joined tables
+        """
+        if '.' in name:
+            table, colname = name.split('.', 1)
+            for join in self._join:
+                if join.table() == table:
+                    return join.model._columns[colname]
+            raise KeyError(name)
+        return self._model._columns[name]
+
+    def prefetch(self, column):
+        """
+        Load related objects with one extra query for all loaded objects,
+        instead of one query per object. column is a ReferenceCol, either
+          in the queried table, the referenced object is available
+            as obj._getRelated(column name)
+          in another table, referencing the queried table, a list with
+            the referencing objects is available as obj._getRelated(table name)
+        Returns self so it can be chained
+        """
+        if not isinstance(column, basium_model.ReferenceCol):
+            self.log.error('Query.prefetch() called with a non-ReferenceCol %s' % column)
+            return None
+        if self._model is None:
+            self.log.error('Query.prefetch() called on a query without table')
+            return None
+        if column._model._table != self._table and column.model._table != self._table:
+            self.log.error('Query.prefetch() called with a column not referencing table %s' % self._table)
+            return None
+        self._prefetch.append(column)
+        return self
+
+    def group(self, *columns):
+        """
+        Group the rows on the specified columns. The query then returns
+        dictionaries with the group columns and the aggregates, instead
+        of objects. Returns self so it can be chained
+        """
+        if not self._checkColumns(columns, 'group'):
+            return None
+        for column in columns:
+            self._group.append(self._Group(column=column))
+        self._rowtype = 'dict'
+        return self
+
+    def aggregate(self, **kwargs):
+        """
+        Add aggregates, calculated by the database for each group, or
+        for all rows if group() is not used. Example:
+            query.group(obj.q.day).aggregate(total=Sum(obj.q.amount), n=Count())
+        The query then returns dictionaries instead of objects, with the
+        group columns and the names of the aggregates as keys.
+        Returns self so it can be chained
+        """
+        for name, aggregate in kwargs.items():
+            if not isinstance(aggregate, Aggregate):
+                self.log.error('Query.aggregate() called with a non-Aggregate %s' % aggregate)
+                return None
+            if aggregate.column is not None and not self._checkColumns([aggregate.column], 'aggregate'):
+                return None
+            self._aggregate.append((name, aggregate))
+        self._rowtype = 'dict'
+        return self
+
+    def isGrouped(self):
+        """Return True if the query returns groups/aggregates instead of rows"""
+        return len(self._group) > 0 or len(self._aggregate) > 0
+
+    def _checkColumns(self, columns, method):
+        """Check that all columns are Columns from the table of the query"""
+        for column in columns:
+            if not isinstance(column, basium_model.Column):
+                self.log.error('Query.%s() called with a non-Column %s' % (method, column))
+                return False
+            if self._model is None:
+                self._model = column._model
+                self._table = column._model._table
+            elif self._table != column._model._table:
+                self.log.error('Query.%s() from multiple tables not implemented' % method)
+                return False
+        return True
+
+    def only(self, *columns):
+        """
+        Only fetch the specified columns from the database, the other
+        columns in the returned objects are not loaded and keeps their
+        default value. The _id column is always fetched.
+        Returns self so it can be chained
+        """
+        if not self._checkColumns(columns, 'only'):
+            return None
+        self._select = ['_id'] + [column.name for column in columns if column.name != '_id']
+        self._rowtype = None
         return self
 
-    def group(self):
-        """Add a group. Returns self so it can be chained"""
+    def values(self, *columns, asdict=False):
+        """
+        Only fetch the specified columns from the database, and return
+        the rows as plain tuples (or dictionaries if asdict is True)
+        instead of objects. Returns self so it can be chained
+        """
+        if not self._checkColumns(columns, 'values'):
+            return None
+        self._select = [column.name for column in columns]
+        if asdict:
+            self._rowtype = 'dict'
+        else:
+            self._rowtype = 'tuple'
         return self
 
+    def columnNames(self):
+        """
+        Return list of column names that should be fetched,
+        or None if all columns should be fetched
+        For grouped queries the names of the aggregates are included
+        """
+        if self.isGrouped():
+            return [group.column.name for group in self._group] + [name for name, aggregate in self._aggregate]
+        if len(self._join) == 0 or self._rowtype is not None:
+            return self._select
+        names = self._select
+        if names is None:
+            names = list(self._model._columns.keys())
+        for join in self._join:
+            names = names + [join.prefix() + colname for colname in join.model._columns]
+        return names
+
+    def selectSql(self, quote=''):
+        """
+        Return the column list for SELECT
+        quote is put around the column names
+        """
+        qualify = len(self._join) > 0
+        if self.isGrouped():
+            columns = [columnSql(group.column, qualify, quote) for group in self._group]
+            for name, aggregate in self._aggregate:
+                columns.append('%s AS %s%s%s' % (aggregate.toSql(quote, qualify), quote, name, quote))
+            return ",".join(columns)
+        if not qualify:
+            if self._select is None:
+                return '*'
+            return ",".join(['%s%s%s' % (quote, colname, quote) for colname in self._select])
+
+        if self._select is None:
+            columns = ['%s.*' % self._table]
+        else:
+            columns = ['%s.%s%s%s' % (self._table, quote, colname, quote) for colname in self._select]
+        for join in self._join:
+            for colname in join.model._columns:
+                columns.append('%s.%s%s%s AS %s%s%s%s' % (join.table(), quote, colname, quote, quote, join.prefix(), colname, quote))
+        return ",".join(columns)
+
     def order(self, column, desc=False):
         """Add a sort order. Returns self so it can be chained"""
         if not isinstance(column, basium_model.Column):
@@ -372,8 +1632,8 @@ class Query():
         if self._model is None:
             self._model = column._model
             self._table = column._model._table
-        elif self._table != column._model._table:
-            self.log.error('Order from multiple tables not implemented')
+        elif self._table != column._model._table and not self._isJoined(column._model._table):
+            self.log.error('Order from multiple tables needs Query.join()')
             return None
         self._order.append(self._Order(column=column, desc=desc))
         return self
@@ -387,64 +1647,337 @@ class Query():
         self._limit = self._Limit(offset, rowcount)
         return self
 
+    def after(self, last):
+        """
+        Keyset pagination, only return rows that comes after last in
+        the sort order. Call after order(), _id is added as the last
+        sort column if needed, to make the order unique.
+        All sort columns must have the same direction.
+
+        last is either the last object on the previous page, or a
+        token returned by Query.token(). Use together with
+        limit(rowcount=n), instead of an offset.
+        Returns self so it can be chained
+        """
+        if self._model is None:
+            self.log.error('Query.after() called on a query without table')
+            return None
+        desc = False
+        if len(self._order) > 0:
+            desc = self._order[0].desc
+        for order in self._order:
+            if order.desc != desc:
+                self.log.error('Query.after() needs the same direction on all sort columns')
+                return None
+        self._keysetColumns()
+        if len(self._order) == 0 or self._order[-1].column.name != '_id':
+            self._order.append(self._Order(column=self._model._columns['_id'], desc=desc))
+
+        if isinstance(last, basium_model.Model):
+            self._after = [last._values[order.column.name] for order in self._order]
+        else:
+            try:
+                values = json.loads(base64.urlsafe_b64decode(last.encode("ascii")).decode("utf-8"))
+            except (ValueError, TypeError, AttributeError):
+                self.log.error('Query.after() called with an incorrect token')
+                return None
+            if not isinstance(values, list) or len(values) != len(self._order):
+                self.log.error('Query.after() token does not match the sort order')
+                return None
+            try:
+                self._after = [keysetValue(order.column, value) for order, value in zip(self._order, values)]
+            except ValueError:
+                self.log.error('Query.after() token has incorrect values')
+                return None
+        return self
+
+    def _keysetColumns(self):
+        """
+        Return the names of the order columns, raises bc.Error if any
+        of them is in a joined table, keyset pagination only handles
+        columns in the queried table
+        """
+        for order in self._order:
+            if order.column._model._table != self._table:
+                raise bc.Error(1, "Keyset pagination on column %s in joined table %s is not supported" %
+                               (order.column.name, order.column._model._table))
+        return [order.column.name for order in self._order]
+
+    def limitOne(self, exists=False):
+        """
+        Return a copy of the query that returns at most one row
+        If exists is True the sort order is also dropped, when it
+        is not needed for keyset pagination
+        """
+        query = copy.copy(self)
+        offset = None
+        if self._limit is not None:
+            offset = self._limit.offset
+        query._limit = self._Limit(offset, 1)
+        if exists and self._after is None:
+            query._order = []
+        return query
+
+    def _database(self, method):
+        if self._db is None:
+            raise bc.Error(1, 'Query.%s() needs a query created with Basium.query()' % method)
+        return self._db
+
+    def first(self):
+        """
+        Return the first object matching the query, or None
+        See Basium.first()
+        """
+        return self._database('first').first(self)
+
+    def get(self):
+        """
+        Return the object matching the query, raises an error if none
+        See Basium.get()
+        """
+        return self._database('get').get(self)
+
+    def exists(self):
+        """
+        Return True if at least one row matches the query
+        See Basium.exists()
+        """
+        return self._database('exists').exists(self)
+
+    def token(self, last):
+        """
+        Return an opaque string for the position after object last in
+        the sort order of this query, that can be passed to after()
+        """
+        columns = self._keysetColumns()
+        if len(columns) == 0 or columns[-1] != '_id':
+            columns.append('_id')
+        values = [last._values[colname] for colname in columns]
+        return base64.urlsafe_b64encode(keysetJson(values).encode("utf-8")).decode("ascii")
+
     def toSql(self):
         """
         Return the query as SQL
         Handles
+        - LEFT JOIN
         - WHERE
-        - GROUP BY (todo)
+        - GROUP BY
         - ORDER BY
         - LIMIT
+
+        The SQL text only depends on the shape of the query, so it is
+        compiled once for each shape and cached, only the values are
+        created on each call
+        """
+        shape = self.shape()
+        try:
+            sql = self._sqlcache[shape]
+        except KeyError:
+            sql = self._compileSql()
+            self._sqlcache[shape] = sql
+        return (sql, self.sqlValues())
+
+    def shape(self):
+        """
+        Return a key describing the structure of the query, without any
+        values. Queries with the same shape gives the same SQL text
+        """
+        select = None
+        if self._select is not None:
+            select = tuple(self._select)
+        return (self._table,
+                select,
+                tuple([join.column.name for join in self._join]),
+                tuple([where.shape() for where in self._where]),
+                tuple([group.column.name for group in self._group]),
+                tuple([(name, aggregate.func, aggregate.colname()) for name, aggregate in self._aggregate]),
+                tuple([(order.column._model._table, order.column.name, order.desc) for order in self._order]),
+                self._after is not None,
+                self._limit is not None)
+
+    def split(self, maxParams):
+        """
+        Return a list of queries, that together returns the same rows as
+        this query, with at most maxParams values in each query.
+        A query can only be split on one IN list, and not if it uses
+        limit(), group(), aggregate() or order() on a joined table
+        """
+        count = self.paramCount()
+        if maxParams is None or count <= maxParams:
+            return [self]
+        wheres = [where for where in self._where if where.isList() and where.operand == IN]
+        if len(wheres) != 1 or self._limit is not None or self.isGrouped():
+            raise bc.Error(1, "Query has %d values, the maximum for the database is %d" % (count, maxParams))
+        for order in self._order:
+            if order.column._model._table != self._table:
+                raise bc.Error(1, "Query has %d values, the maximum for the database is %d" % (count, maxParams))
+        where = wheres[0]
+        values = list(dict.fromkeys(where.value))     # unique, keeps the order
+        size = maxParams - (count - where.paramCount())
+        if size < 1:
+            raise bc.Error(1, "Query has %d values, the maximum for the database is %d" % (count, maxParams))
+        size = 1 << (size.bit_length() - 1)     # the lists are padded to a power of two
+
+        queries = []
+        for i in range(0, len(values), size):
+            query = copy.copy(self)
+            query._where = list(self._where)
+            query._where[self._where.index(where)] = self._Where(where.column, where.operand, values[i:i + size])
+            queries.append(query)
+        return queries
+
+    def paramCount(self):
+        """Return the number of values for the placeholders in the SQL text"""
+        count = 0
+        for where in self._where:
+            count += where.paramCount()
+        if self._after is not None:
+            count += len(self._after)
+        if self._limit is not None:
+            count += 2
+        return count
+
+    def sortRows(self, rows, rowtype=None):
+        """
+        Sort rows in the order of the query, used when the rows
+        are loaded with several queries
+        rowtype overrides the row type of the query, see BasiumOrm.load()
+        """
+        if rowtype is None:
+            rowtype = self._rowtype
+        for order in reversed(self._order):
+            name = order.column.name
+            if rowtype in ('tuple', 'namedtuple'):
+                select = self.columnNames()
+                if select is None:
+                    select = list(self._model._columns.keys())
+                if name not in select:
+                    raise bc.Error(1, "Cannot sort on %s, not in the selected columns" % name)
+                ix = select.index(name)
+
+                def value(row):
+                    return row[ix]
+            elif rowtype == 'dict':
+                def value(row):
+                    return row.get(name, None)
+            else:
+                def value(row):
+                    return row._values[name]
+            rows.sort(key=lambda row: (value(row) is not None, value(row)), reverse=order.desc)
+
+    def sqlValues(self):
+        """
+        Return the values for the placeholders in the SQL text
         """
         value = []
-        sql = ''
-        if len(self._where) > 0:
+        for where in self._where:
+            value.extend(where.sqlValues())
+        if self._after is not None:
+            for order, after in zip(self._order, self._after):
+                value.append(order.column.toSql(after))
+        if self._limit is not None:
+            value.extend(self._limit.sqlValues())
+        return value
+
+    def _compileSql(self):
+        qualify = len(self._join) > 0
+        sql = ''.join([join.toSql() for join in self._join])
+        conditions = [where.condition(qualify) for where in self._where]
+        if self._after is not None:
+            conditions.append(self._keysetSql(qualify))
+        if len(conditions) > 0:
             sql += ' where ('
-            addComma = False
-            if self._where is not None:
-                for where in self._where:
-                    if addComma:
-                        sql += ' and '
-                    else:
-                        addComma = True
-                    sql2, value2 = where.toSql()
-                    sql += sql2
-                    value.append(value2)
-                sql += ')'
+            sql += ' and '.join(conditions)
+            sql += ')'
 
-        if len(self._order) > 0:
+        if len(self._group) > 0:
+            sql += " GROUP BY "
+            sql += ",".join([group.toSql(qualify) for group in self._group])
+
+        orders = self._sortOrder()
+        if len(orders) > 0:
             sql += " ORDER BY "
             addComma = False
-            for order in self._order:
+            for order in orders:
                 if addComma:
                     sql += ','
                 else:
                     addComma = True
-                sql += order.toSql()
+                sql += order.toSql(qualify)
 
         if self._limit is not None:
             sql += self._limit.toSql()
 
-        return (sql, value)
+        return sql
+
+    def _sortOrder(self):
+        """
+        Return the sort order used in the SQL. If the result is limited
+        or paged, _id is added last in the direction of the last sort
+        column, so rows with the same values in the sort columns always
+        comes in the same order, the same order as after() uses
+        """
+        if len(self._order) == 0 or self.isGrouped():
+            return self._order
+        if self._limit is None and self._after is None:
+            return self._order
+        last = self._order[-1]
+        if last.column.name == '_id' and last.column._model._table == self._table:
+            return self._order
+        return self._order + [self._Order(column=self._model._columns['_id'], desc=last.desc)]
+
+    def _keysetSql(self, qualify=False):
+        """
+        Return the condition for keyset pagination, a row value comparison
+        on the sort columns so the database can use an index
+        """
+        columns = [columnSql(order.column, qualify) for order in self._order]
+        operand = GT
+        if self._order[0].desc:
+            operand = LT
+        if len(columns) == 1:
+            return '%s %s %%s' % (columns[0], operand)
+        return '(%s) %s (%s)' % (",".join(columns), operand, ",".join(["%s"] * len(columns)))
 
     def encode(self):
         """Return the query as a string that can be appended to an URI"""
         url = []
 
+        # join, first so decode() knows the joined tables
+        for join in self._join:
+            url.append(join.encode())
+
         # where
         for where in self._where:
-            url.append(where.encode())
+            url.append(where.encode(self._table))
 
         # group
+        for group in self._group:
+            url.append(group.encode())
+        for name, aggregate in self._aggregate:
+            colname = aggregate.colname()
+            if colname is None:
+                colname = ''
+            url.append("ag=" + urllib.parse.quote("%s,%s,%s" % (name, aggregate.func, colname), ','))
 
         # order
         for order in self._order:
-            url.append(order.encode())
+            url.append(order.encode(self._table))
+
+        # keyset pagination
+        if self._after is not None:
+            url.append("a=" + urllib.parse.quote(keysetJson(self._after)))
 
         # limit
         if self._limit:
             url.append(self._limit.encode())
 
+        # selected columns
+        if self._select is not None:
+            url.append("c=" + urllib.parse.quote(",".join(self._select), ','))
+        if self._rowtype is not None:
+            url.append("v=" + self._rowtype)
+
         return "&".join(url)
 
     def decode(self, url):
@@ -455,21 +1988,68 @@ class Query():
 
         self._reset()
         for (key, val) in u:
-            if key == 'w':
+            if key == 'j':
+                j = self._Join()
+                j.decode(self._model, val)
+                self._join.append(j)
+            elif key == 'w':
                 w = self._Where()
-                w.decode(self._model, val)
+                w.decode(self, val)
                 self._where.append(w)
+            elif key == 'x':
+                x = Q()
+                x.decode(self, val)
+                self._where.append(x)
             elif key == 'g':
                 g = self._Group()
-                g.decode(val)
-                self._group.append(self._model, g)
+                g.decode(self._model, val)
+                self._group.append(g)
+                self._rowtype = 'dict'
+            elif key == 'ag':
+                tmp = val.split(',')
+                if len(tmp) != 3 or tmp[1] not in aggregates or (tmp[2] and tmp[2] not in self._model._columns):
+                    self.log.error("Incorrect aggregate %s, url='%s' in URL" % (val, url))
+                    continue
+                name, func, colname = tmp
+                column = None
+                if colname:
+                    column = self._model._columns[colname]
+                self._aggregate.append((name, aggregates[func](column)))
+                self._rowtype = 'dict'
             elif key == 'o':
                 o = self._Order()
-                o.decode(self._model, val)
+                o.decode(self, val)
                 self._order.append(o)
             elif key == 'l':
                 l = self._Limit()
                 l.decode(val)
                 self._limit = l
+            elif key == 'a':
+                try:
+                    self._after = json.loads(val)
+                except ValueError:
+                    self.log.error("Incorrect keyset value %s, url='%s' in URL" % (val, url))
+            elif key == 'c':
+                self._select = []
+                for colname in val.split(','):
+                    if colname not in self._model._columns:
+                        self.log.error("Incorrect column %s, url='%s' in URL" % (colname, url))
+                        continue
+                    self._select.append(colname)
+            elif key == 'v':
+                if val in ['tuple', 'dict']:
+                    self._rowtype = val
+                else:
+                    self.log.error("Incorrect row type %s, url='%s' in URL" % (val, url))
             else:
                 self.log.error("Incorrect key=%s, url='%s' in URL" % (key, url))
+        if self._after is not None:
+            if not isinstance(self._after, list) or len(self._after) != len(self._order):
+                self.log.error("Keyset values does not match sort order, url='%s' in URL" % url)
+                self._after = None
+            else:
+                try:
+                    self._after = [keysetValue(order.column, value) for order, value in zip(self._order, self._after)]
+                except ValueError:
+                    self.log.error("Incorrect keyset values, url='%s' in URL" % url)
+                    self._after = None
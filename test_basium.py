@@ -65,16 +65,24 @@ Preparation to database before testing:
 
 """
 
+import os
 import sys
 import time
 import decimal
 import datetime
 import unittest
+import array
+import threading
+import asyncio
 import logging
+import subprocess
 
 import basium_common as bc
 import basium
 import basium_model
+import basium_orm
+import basium_driver
+import basium_async
 import wsgi.handler
 
 import test_tables
@@ -165,6 +173,7 @@ class TestFunctions(unittest.TestCase):
         self.db = basium.Basium(driver=self.driver, dbconf=self.dbconf, checkTables=True) #, logger=logger)
         self.db.log.logger.setLevel(logging.ERROR)
         self.db.addClass(self.Cls)
+        self.db.addClass(test_tables.BasiumTestRef)
         if not self.db.start():
             self.fail("Cannot start database driver")
 
@@ -234,6 +243,30 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(test1.varcharTest, test2.varcharTest, msg=
             "Update failed, expected '%s' in field, got '%s'" % (test1.varcharTest, test2.varcharTest))
 
+    def testUpdateChanged(self):
+        """
+        Test that update only writes the changed columns
+        """
+        test1 = objFactory.new(self.Cls, 1)
+        try:
+            self.db.store(test1)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Can't store new object %s" % e)
+
+        # bypass the change tracking, this column should not be written
+        test1._values['intTest'] = 4711
+        test1.varcharTest = "changed text"
+        try:
+            self.db.store(test1)
+            data = self.db.load(self.Cls(test1._id))
+        except bc.Error as e:
+            self.assertFalse(True, msg="Can't update object %s" % e)
+
+        test2 = data[0]
+        self.assertEqual(test2.varcharTest, "changed text")
+        self.assertEqual(test2.intTest, 1, msg="Unchanged column was written in update")
+        self.assertEqual(len(test2._dirty), 0)
+
     def testQuery(self):
         """
         Test the query functionality
@@ -262,6 +295,616 @@ class TestFunctions(unittest.TestCase):
             for i in range(0, 10):
                 self.assertEqual(data[i].intTest, i+103)
 
+    def testLimit(self):
+        """
+        Test order and limit, same query shape with different values
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(400, 410)]
+        try:
+            self.db.storeMany(objs)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+
+        obj = self.Cls()
+        for offset in range(0, 3):
+            query = self.db.query().filter(obj.q._id, '>=', objs[0]._id)
+            query.order(obj.q._id, desc=True).limit(offset, 3)
+            try:
+                data = self.db.load(query)
+            except bc.Error as e:
+                self.assertFalse(True, msg="Can't query objects %s" % e)
+            self.assertEqual([o.intTest for o in data], [409 - offset - i for i in range(0, 3)])
+
+    def testOnlyValues(self):
+        """
+        Test fetching a subset of the columns, as objects and as plain rows
+        """
+        test1 = objFactory.new(self.Cls, 1)
+        try:
+            self.db.store(test1)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Can't store new object %s" % e)
+
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '=', test1._id).only(obj.q.varcharTest)
+        data = self.db.load(query)
+        self.assertEqual(data[0]._id, test1._id)
+        self.assertEqual(data[0].varcharTest, test1.varcharTest)
+        self.assertEqual(data[0].intTest, None)
+
+        query = self.db.query().filter(obj.q._id, '=', test1._id).values(obj.q.intTest, obj.q.dateTest)
+        self.assertEqual(self.db.load(query), [(test1.intTest, test1.dateTest)])
+
+        query = self.db.query().filter(obj.q._id, '=', test1._id).values(obj.q.intTest, asdict=True)
+        self.assertEqual(self.db.load(query), [{'intTest': test1.intTest}])
+
+    def testKeyset(self):
+        """
+        Test keyset pagination, with an object and with a token
+        """
+        objs = [objFactory.new(self.Cls, p) for p in [505, 501, 503, 502, 504, 501]]
+        try:
+            self.db.storeMany(objs)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+
+        obj = self.Cls()
+        data = []
+        last = None
+        while True:
+            query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).order(obj.q.intTest).limit(rowcount=2)
+            if last is not None:
+                query.after(last)
+            page = self.db.load(query)
+            if len(page) == 0:
+                break
+            data.extend(page)
+            last = page[-1]
+        self.assertEqual([o.intTest for o in data], [501, 501, 502, 503, 504, 505])
+        self.assertEqual(len(set([o._id for o in data])), 6)
+
+        query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).order(obj.q.intTest, desc=True)
+        token = query.token(data[3])
+        page = self.db.load(query.after(token))
+        self.assertEqual([o.intTest for o in page], [502, 501, 501])
+
+        # descending with tied values, the first page must use the same order as the next ones
+        objs = [objFactory.new(self.Cls, p) for p in [510, 511, 511, 511, 511, 510, 511]]
+        self.db.storeMany(objs)
+        data = []
+        token = None
+        while True:
+            query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).order(obj.q.intTest, desc=True).limit(rowcount=3)
+            if token is not None:
+                query.after(token)
+            page = self.db.load(query)
+            if len(page) == 0:
+                break
+            data.extend(page)
+            token = query.token(page[-1])
+        self.assertEqual([o.intTest for o in data], [511] * 5 + [510] * 2)
+        self.assertEqual(sorted([o._id for o in data]), sorted([o._id for o in objs]))
+
+    def testAggregate(self):
+        """
+        Test GROUP BY and aggregates, calculated by the database
+        """
+        objs = [objFactory.new(self.Cls, p) for p in [601, 602, 601, 603, 601]]
+        try:
+            self.db.storeMany(objs)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).group(obj.q.intTest).order(obj.q.intTest)
+        query.aggregate(n=basium_orm.Count(), total=basium_orm.Sum(obj.q.intTest))
+        data = self.db.load(query)
+        self.assertEqual(data, [{'intTest': 601, 'n': 3, 'total': 1803},
+                                {'intTest': 602, 'n': 1, 'total': 602},
+                                {'intTest': 603, 'n': 1, 'total': 603}])
+        self.assertEqual(self.db.count(query), 3)
+
+        query = self.db.query().filter(obj.q._id, '>=', objs[0]._id)
+        query.aggregate(low=basium_orm.Min(obj.q.intTest), high=basium_orm.Max(obj.q.intTest))
+        self.assertEqual(self.db.load(query), [{'low': 601, 'high': 603}])
+
+    def testFirstExists(self):
+        """
+        Test first(), get() and exists()
+        """
+        objs = [objFactory.new(self.Cls, p) for p in [702, 701, 703]]
+        try:
+            self.db.storeMany(objs)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).order(obj.q.intTest)
+        self.assertEqual(query.first().intTest, 701)
+        self.assertTrue(query.exists())
+        self.assertEqual(len(self.db.load(query)), 3)
+
+        self.assertEqual(self.db.query().filter(obj.q._id, '=', objs[2]._id).get().intTest, 703)
+
+        query = self.db.query().filter(obj.q.intTest, '=', 799)
+        self.assertEqual(query.first(), None)
+        self.assertFalse(query.exists())
+        self.assertRaises(bc.Error, query.get)
+
+    def testJoin(self):
+        """
+        Test loading referenced objects with join() and prefetch()
+        """
+        parents = [objFactory.new(self.Cls, p) for p in [801, 802, 803]]
+        try:
+            self.db.storeMany(parents)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+        children = []
+        for parent, name in [(parents[0], 'a'), (parents[0], 'b'), (parents[1], 'c'), (None, 'd')]:
+            child = test_tables.BasiumTestRef()
+            if parent is not None:
+                child.parent = parent._id
+            child.name = name
+            children.append(child)
+        self.db.storeMany(children)
+
+        obj = self.Cls()
+        ref = test_tables.BasiumTestRef()
+        query = self.db.query().filter(ref.q._id, '>=', children[0]._id).join(ref.q.parent).order(ref.q.name)
+        data = self.db.load(query)
+        self.assertEqual([o.name for o in data], ['a', 'b', 'c', 'd'])
+        self.assertEqual([o._getRelated('parent') and o._getRelated('parent').intTest for o in data], [801, 801, 802, None])
+
+        query = self.db.query().filter(ref.q._id, '>=', children[0]._id).join(ref.q.parent)
+        data = self.db.load(query.filter(obj.q.intTest, '=', 802))
+        self.assertEqual([o.name for o in data], ['c'])
+
+        query = self.db.query().filter(ref.q._id, '>=', children[0]._id).prefetch(ref.q.parent).order(ref.q.name)
+        data = self.db.load(query)
+        self.assertEqual(data[2]._getRelated('parent'), parents[1])
+        self.assertEqual(data[3]._getRelated('parent'), None)
+
+        query = self.db.query().filter(obj.q._id, '>=', parents[0]._id).prefetch(ref.q.parent).order(obj.q._id)
+        data = self.db.load(query)
+        self.assertEqual([[c.name for c in o._getRelated(ref._table)] for o in data], [['a', 'b'], ['c'], []])
+
+    def testInLoadMany(self):
+        """
+        Test IN, NOT IN and loadMany(), also when split in several queries
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(901, 911)]
+        try:
+            self.db.storeMany(objs)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+        ids = [obj._id for obj in objs]
+
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q.intTest, basium_orm.IN, [903, 901, 999]).order(obj.q.intTest)
+        self.assertEqual([o.intTest for o in self.db.load(query)], [901, 903])
+        query = self.db.query().filter(obj.q._id, basium_orm.IN, ids).filter(obj.q.intTest, basium_orm.NOT_IN, [903, 901])
+        self.assertEqual(self.db.count(query), 8)
+        self.assertFalse(self.db.query().filter(obj.q._id, basium_orm.IN, []).exists())
+
+        maxParams = self.db.driver.maxParams
+        self.db.driver.maxParams = 3
+        try:
+            query = self.db.query().filter(obj.q._id, basium_orm.IN, ids).order(obj.q.intTest, desc=True)
+            self.assertEqual([o.intTest for o in self.db.load(query)], list(range(910, 900, -1)))
+            self.assertEqual(self.db.count(query), 10)
+            data = self.db.loadMany(self.Cls, [ids[5], ids[1], -1, ids[7], ids[2]])
+            self.assertEqual([o.intTest for o in data], [906, 902, 908, 903])
+        finally:
+            self.db.driver.maxParams = maxParams
+
+    def testOr(self):
+        """
+        Test filter with OR and NOT expressions
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(1001, 1006)]
+        try:
+            self.db.storeMany(objs)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+
+        obj = self.Cls()
+        Q = basium_orm.Q
+        query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).order(obj.q.intTest)
+        query.filter(Q(obj.q.intTest, '=', 1001) | Q(obj.q.intTest, '>', 1002) & ~Q(obj.q.intTest, basium_orm.IN, [1004]))
+        self.assertEqual([o.intTest for o in self.db.load(query)], [1001, 1003, 1005])
+        self.assertEqual(self.db.count(query), 3)
+
+    def testTransaction(self):
+        """
+        Test transaction(), commit, rollback and nested savepoints
+        """
+        obj = self.Cls()
+        with self.db.transaction():
+            test1 = objFactory.new(self.Cls, 1101)
+            self.db.store(test1)
+            try:
+                with self.db.transaction():
+                    test2 = objFactory.new(self.Cls, 1102)
+                    self.db.store(test2)
+                    raise ValueError("rollback")
+            except ValueError:
+                pass
+        query = self.db.query().filter(obj.q.intTest, basium_orm.IN, [1101, 1102, 1103])
+        self.assertEqual([o.intTest for o in self.db.load(query)], [1101])
+
+        test3 = objFactory.new(self.Cls, 1103)
+        try:
+            with self.db.transaction():
+                self.db.store(test3)
+                self.db.delete(test1)
+                raise ValueError("rollback")
+        except ValueError:
+            pass
+        self.assertEqual([o.intTest for o in self.db.load(query)], [1101])
+
+        # the objects are restored, so they can be stored again
+        self.assertEqual(test2._id, -1)
+        self.assertEqual(test3._id, -1)
+        self.assertGreaterEqual(test1._id, 0)
+        test1.varcharTest = "changed in transaction"
+        try:
+            with self.db.transaction():
+                self.db.store(test1)
+                with self.db.transaction():
+                    self.db.store(test2)
+                raise ValueError("rollback")
+        except ValueError:
+            pass
+        self.assertEqual(test1._dirty, set(['varcharTest']))
+        self.assertEqual(test2._id, -1)
+        self.db.storeMany([test1, test2])
+        self.assertEqual(self.db.load(self.Cls(test1._id))[0].varcharTest, "changed in transaction")
+        self.assertEqual(sorted([o.intTest for o in self.db.load(query)]), [1101, 1102])
+
+    def testSavepointError(self):
+        """
+        A savepoint that fails must raise bc.Error
+        """
+        if self.driver == 'json':
+            return
+        with self.db.transaction():
+            self.db.driver.begin()
+            # remove the savepoint, so releasing it fails
+            self.db.driver.execute("RELEASE SAVEPOINT basium_1")
+            self.assertRaises(bc.Error, self.db.driver.commit)
+
+    def testIterLoad(self):
+        """
+        Test the iterLoad functionality, with a nested query for
+        each returned object
+        """
+        first = None
+        for rowid in range(200, 205):
+            obj1 = objFactory.new(self.Cls, rowid)
+            try:
+                self.db.store(obj1)
+            except bc.Error as e:
+                self.assertFalse(True, msg="Could not store object %s" % e)
+            if not first:
+                first = obj1._id
+
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '>=', first).filter(obj.q._id, '<', first + 5)
+        data = []
+        try:
+            for obj2 in self.db.iterLoad(query, batchsize=2):
+                rows = self.db.load(self.Cls(obj2._id))
+                self.assertEqual(rows[0], obj2)
+                data.append(obj2)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Can't iterate over objects %s" % e)
+
+        self.assertEqual(len(data), 5, msg="Wrong number of objects returned, expected %s got %s" % (5, len(data)))
+        for i in range(0, len(data)):
+            self.assertEqual(data[i].intTest, i + 200)
+
+    def testAsync(self):
+        """
+        Test the asyncio interface, concurrent store and async iteration
+        """
+        adb = basium_async.AsyncBasium(driver=self.driver, dbconf=self.dbconf, checkTables=False, workers=2)
+        adb.addClass(self.Cls)
+
+        async def run():
+            self.assertTrue(await adb.start())
+            objs = [objFactory.new(self.Cls, p) for p in range(1200, 1206)]
+            await asyncio.gather(*[adb.store(obj) for obj in objs])
+            obj = self.Cls()
+            query = adb.query().filter(obj.q.intTest, '>=', 1200).filter(obj.q.intTest, '<', 1206).order(obj.q.intTest)
+            self.assertEqual(await adb.count(query), 6)
+            rows = await adb.load(query)
+            self.assertEqual([o.intTest for o in rows], list(range(1200, 1206)))
+            data = []
+            async for o in adb.iterLoad(query, batchsize=4):
+                data.append(o.intTest)
+            self.assertEqual(data, list(range(1200, 1206)))
+            rows = await adb.load(query, rows='dict')
+            self.assertEqual([row['intTest'] for row in rows], list(range(1200, 1206)))
+            data = []
+            async for row in adb.iterLoad(query, batchsize=4, rows='tuple'):
+                data.append(row)
+            # stop early, the worker must be released
+            it = adb.iterLoad(query, batchsize=1, prefetch=1)
+            self.assertEqual((await it.__anext__()).intTest, 1200)
+            await asyncio.wait_for(it.aclose(), 5)
+            self.assertEqual(await adb.count(query), 6)
+            self.assertEqual(len(data), 6)
+            self.assertIsInstance(data[0], tuple)
+            query = adb.query().filter(obj.q.intTest, '>=', 1200).filter(obj.q.intTest, '<', 1206)
+            self.assertEqual(await adb.delete(query), 6)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            adb.close()
+            loop.close()
+
+    def testLoadColumns(self):
+        """
+        Test loading the result as one array per column
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(1300, 1305)]
+        self.db.storeMany(objs)
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q.intTest, '>=', 1300).filter(obj.q.intTest, '<', 1305).order(obj.q.intTest)
+        columns = self.db.loadColumns(query, batchsize=2)
+        self.assertEqual(set(columns.keys()), set(obj._columns.keys()))
+        self.assertEqual(list(columns['intTest']), list(range(1300, 1305)))
+        self.assertEqual(list(columns['varcharTest']), [o.varcharTest for o in objs])
+        self.assertEqual(list(columns['floatTest']), [o.floatTest for o in objs])
+        self.assertEqual(list(columns['booleanTest']), [o.booleanTest for o in objs])
+        if basium_orm.numpy is None:
+            self.assertIsInstance(columns['intTest'], array.array)
+            self.assertEqual(list(columns['datetimeTest']), [o.datetimeTest for o in objs])
+
+        columns = self.db.loadColumns(query.values(obj.q.intTest))
+        self.assertEqual(list(columns.keys()), ['intTest'])
+        self.assertEqual(list(columns['intTest']), list(range(1300, 1305)))
+
+    def testLoadRows(self):
+        """
+        Test loading plain rows instead of objects
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(1400, 1403)]
+        self.db.storeMany(objs)
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q.intTest, '>=', 1400).filter(obj.q.intTest, '<', 1403).order(obj.q.intTest)
+
+        rows = self.db.load(query, rows='dict')
+        self.assertEqual(rows, [o._values for o in objs])
+        rows = self.db.load(query, rows='tuple')
+        self.assertEqual(rows, [tuple(o._values.values()) for o in objs])
+        rows = self.db.load(query, rows='namedtuple')
+        self.assertEqual([(row.id, row.intTest, row.datetimeTest) for row in rows],
+                         [(o._id, o.intTest, o.datetimeTest) for o in objs])
+        self.assertEqual(list(self.db.iterLoad(query, rows='namedtuple')), rows)
+        self.assertRaises(bc.Error, self.db.load, query, rows='list')
+
+        ref = test_tables.BasiumTestRef()
+        ref.parent = objs[0]._id
+        ref.name = 'rows'
+        self.db.store(ref)
+        query = self.db.query().filter(ref.q.name, '=', 'rows').join(ref.q.parent)
+        rows = self.db.load(query, rows='dict')
+        self.assertEqual(rows[0]['parent__intTest'], 1400)
+        self.assertEqual(rows[0]['parent__datetimeTest'], objs[0].datetimeTest)
+
+    def testNativeTypes(self):
+        """
+        Columns marked with nativeType must come from the driver with the python type
+        """
+        obj1 = objFactory.new(self.Cls, 1500)
+        self.db.store(obj1)
+        query = self.db.query().filter(obj1.q._id, '=', obj1._id)
+        cursor = self.db.driver.select(query)
+        names = [d[0] for d in cursor.description]
+        row = list(cursor)[0]
+        for colname, column in obj1._columns.items():
+            if column.nativeType:
+                value = row[names.index(colname)]
+                self.assertEqual(value, obj1._values[colname], msg="Column %s" % colname)
+                self.assertIs(type(value), type(obj1._values[colname]), msg="Column %s" % colname)
+
+    def testNullValues(self):
+        """
+        None must be stored as NULL and loaded as None
+        """
+        obj1 = objFactory.new(self.Cls, 1600)
+        for colname, column in obj1._iterNameColumn():
+            if column.nullable and not column.primary_key:
+                obj1._values[colname] = None
+        self.db.store(obj1)
+        obj2 = self.db.load(self.Cls(obj1._id))[0]
+        self.assertEqual(obj2._values, obj1._values)
+        rows = self.db.load(self.db.query().filter(obj1.q._id, '=', obj1._id), rows='dict')
+        self.assertIsNone(rows[0]['intTest'])
+
+        if self.driver != 'sqlite':
+            return
+        # older versions stored None as the text 'NULL'
+        self.db.driver.execute("UPDATE %s SET booleanTest='NULL', datetimeTest='NULL', decimalTest='NULL', "
+                               "floatTest='NULL', intTest='NULL' WHERE _id=?" % obj1._table, [obj1._id])
+        obj2 = self.db.load(self.Cls(obj1._id))[0]
+        for colname in ['booleanTest', 'datetimeTest', 'decimalTest', 'floatTest', 'intTest']:
+            self.assertIsNone(obj2._values[colname], msg="Column %s" % colname)
+        query = self.db.query().filter(obj1.q._id, '=', obj1._id).values(obj1.q.intTest, obj1.q.floatTest)
+        self.assertEqual(self.db.load(query, rows='tuple'), [(None, None)])
+        columns = self.db.loadColumns(query)
+        self.assertIsNone(columns['intTest'][0])
+        self.assertIsNone(columns['floatTest'][0])
+        self.db.driver.execute("UPDATE %s SET dateTest='not a date' WHERE _id=?" % obj1._table, [obj1._id])
+        self.assertRaises(bc.Error, self.db.load, self.Cls(obj1._id))
+        self.db.delete(obj1)
+
+    def testHydrateNull(self):
+        """
+        NULL values from the driver must be None in the loaded object
+        """
+        names = list(self.Cls._columns.keys())
+        description = [(name, None, None, None, None, None, None) for name in names]
+        hydrate = self.db._hydrator(self.Cls, description)
+        for null in [None, 'NULL']:
+            row = [1] + [None if not basium_orm.needsConversion(self.Cls._columns[name]) else null for name in names[1:]]
+            obj = hydrate(row)
+            for name in names[1:]:
+                self.assertIsNone(obj._values[name], msg="Column %s" % name)
+
+        # the hydrate functions are cached with a limited size
+        self.assertIs(self.db._hydrator(self.Cls, description), hydrate)
+        maxsize = self.db._hydrators.maxsize
+        self.db._hydrators.maxsize = 2
+        try:
+            for i in range(1, 5):
+                self.db._hydrator(self.Cls, description[:i])
+            self.assertEqual(len(self.db._hydrators), 2)
+        finally:
+            self.db._hydrators.maxsize = maxsize
+
+    def testThreads(self):
+        """
+        Store and load objects from several threads, sharing the Basium instance
+        """
+        errors = []
+
+        def run(p):
+            try:
+                for i in range(0, 5):
+                    obj1 = objFactory.new(self.Cls, p * 10 + i)
+                    self.db.store(obj1)
+                    rows = self.db.load(self.Cls(obj1._id))
+                    if rows[0] != obj1:
+                        errors.append("Loaded object differs for %s" % obj1._id)
+            except bc.Error as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=run, args=(p,)) for p in range(140, 144)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def testIndexes(self):
+        """
+        Verify that the indexes are created, and that missing and
+        extra indexes are reported
+        """
+        ref = test_tables.BasiumTestRef()
+        self.assertEqual(self.db.verifyTable(ref), [])
+
+        class BasiumTestRefIndex(test_tables.BasiumTestRef):
+            _table = 'basiumtestref'
+            _indexes = [basium_model.Index('parent', 'name'), basium_model.Index('name', 'parent')]
+
+        refIndex = BasiumTestRefIndex()
+        actions = self.db.verifyTable(refIndex)
+        self.assertEqual(len(actions), 1)
+        self.assertTrue(actions[0].unattended)
+        self.db.modifyTable(refIndex, actions)
+        self.assertEqual(self.db.verifyTable(refIndex), [])
+
+        # the new index is not used by the original class
+        actions = self.db.verifyTable(ref)
+        self.assertEqual(len(actions), 1)
+        self.assertFalse(actions[0].unattended)
+        self.assertIn('DROP', actions[0].sqlcmd)
+        self.db.driver.execute(actions[0].sqlcmd, commit=True)
+        self.assertEqual(self.db.verifyTable(ref), [])
+
+    def testStoreMany(self):
+        """
+        Store multiple objects in one call, read them out again and
+        compare if they are equal
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(300, 310)]
+        try:
+            ids = self.db.storeMany(objs, chunksize=4)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Could not store objects %s" % e)
+
+        self.assertEqual(len(set(ids)), len(objs), msg="Expected unique ids, got %s" % ids)
+        for obj1, _id in zip(objs, ids):
+            self.assertEqual(obj1._id, _id)
+            try:
+                rows = self.db.load(self.Cls(_id))
+            except bc.Error as e:
+                self.assertFalse(True, msg="Could not load object %s" % e)
+            self.assertEqual(obj1, rows[0], msg="Stored and loaded object does not have same content")
+
+    def testStoreManyError(self):
+        """
+        If one row fails, none of the rows are stored
+        """
+        if self.driver == 'json':
+            return
+        obj = self.Cls()
+        objs = [objFactory.new(self.Cls, p) for p in range(310, 314)]
+        objs[2].varcharTest = object()     # cannot be stored
+        self.assertRaises(bc.Error, self.db.storeMany, objs)
+        self.db.store(objFactory.new(self.Cls, 314))
+        query = self.db.query().filter(obj.q.intTest, basium_orm.IN, list(range(310, 315)))
+        self.assertEqual([o.intTest for o in self.db.load(query)], [314])
+
+    def testSession(self):
+        """
+        Test the identity map, load by _id should return the same object
+        """
+        self.db.startSession()
+        try:
+            test1 = objFactory.new(self.Cls, 1)
+            self.db.store(test1)
+            _id = test1._id
+            self.assertIs(self.db.load(self.Cls(_id))[0], test1)
+
+            self.db.session.clear()
+            test2 = self.db.load(self.Cls(_id))[0]
+            self.assertIsNot(test2, test1)
+            self.assertIs(self.db.load(self.Cls(_id))[0], test2)
+
+            self.db.delete(test2)
+            self.assertIsNone(self.db.session.get(test2._table, _id))
+            self.assertRaises(bc.Error, self.db.load, self.Cls(_id))
+        finally:
+            self.db.endSession()
+
+    def testCache(self):
+        """
+        Test the query result cache, hits and invalidation on store
+        """
+        cache = basium_orm.QueryCache(maxsize=2, ttl=60)
+        self.db.setCache(cache)
+        try:
+            test1 = objFactory.new(self.Cls, 1)
+            self.db.store(test1)
+            query = self.db.query().filter(test1.q._id, '=', test1._id)
+            data1 = self.db.load(query)
+            data2 = self.db.load(query)
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(data1, data2)
+            self.assertIsNot(data1[0], data2[0])
+
+            n = self.db.count(query)
+            self.assertEqual(self.db.count(query), n)
+            self.assertEqual(cache.hits, 2)
+
+            test1.varcharTest = "changed text"
+            self.db.store(test1)
+            self.assertEqual(cache.stats()["size"], 0)
+            self.assertEqual(self.db.load(query)[0].varcharTest, "changed text")
+
+            self.db.load(self.db.query().filter(test1.q._id, '<', 0))
+            self.db.load(self.db.query().filter(test1.q._id, '>', 0))
+            self.assertEqual(cache.evictions, 1)
+        finally:
+            self.db.setCache(None)
+
     def testDelete(self):
         """
         Test the delete functionality
@@ -339,6 +982,343 @@ class TestModel(unittest.TestCase):
         self.assertEqual(t.intTest, 42)
         self.assertEqual(t.varcharTest, "default string")
 
+    def testSchema(self):
+        class TestModelSub(self.TestModelDefault):
+            extraTest = basium_model.IntegerCol()
+
+        t1 = self.TestModelDefault()
+        t2 = self.TestModelDefault()
+        self.assertIs(t1._columns, t2._columns)
+        self.assertIs(t1.q.intTest, self.TestModelDefault.intTest)
+        self.assertEqual(list(t1._columns.keys())[0], '_id')
+        self.assertIs(t1.q._id._model, self.TestModelDefault)
+        t1.intTest = 43
+        self.assertEqual(t2.intTest, 42)
+
+        sub = TestModelSub()
+        self.assertEqual(sub._table, 'testmodelsub')
+        self.assertEqual(sub.intTest, 42)
+        self.assertIs(sub.q.intTest._model, TestModelSub)
+        self.assertIs(t1.q.intTest._model, self.TestModelDefault)
+        self.assertIn('extraTest', sub._columns)
+        self.assertNotIn('extraTest', t1._columns)
+
+    def testDescriptor(self):
+        t = self.TestModel(5)
+        self.assertFalse(hasattr(t, '__dict__'))
+        self.assertIsInstance(self.TestModel.intTest, basium_model.IntegerCol)
+        self.assertEqual(t._id, 5)
+        t.intTest = 17
+        self.assertEqual(t.intTest, 17)
+        self.assertEqual(t._values['intTest'], 17)
+        self.assertEqual(t._dirty, set(['intTest']))
+        t._values['intTest'] = 18
+        self.assertEqual(t.intTest, 18)
+        with self.assertRaises(AttributeError):
+            t.notAColumn = 1
+
+    def testOwnSlots(self):
+        """
+        A model can declare its own __slots__ for attributes that are not columns
+        """
+        class TestModelSlots(basium_model.Model):
+            __slots__ = ('notAColumn',)
+            intTest = basium_model.IntegerCol(default=42)
+
+        class TestModelSlotsSub(TestModelSlots):
+            varcharTest = basium_model.VarcharCol()
+
+        for cls in [TestModelSlots, TestModelSlotsSub]:
+            t = cls()
+            t.notAColumn = 1
+            self.assertEqual(t.notAColumn, 1)
+            self.assertEqual(t.intTest, 42)
+            self.assertNotIn('notAColumn', t._columns)
+            self.assertFalse(hasattr(t, '__dict__'))
+
+    def testIndexes(self):
+        class TestModelIndex(basium_model.Model):
+            intTest = basium_model.IntegerCol(index=True)
+            varcharTest = basium_model.VarcharCol(unique=True)
+            _indexes = [basium_model.Index('intTest', 'varcharTest', name='int_varchar')]
+
+        indexes = [(i.name, i.columns, i.unique) for i in TestModelIndex._indexes]
+        self.assertEqual(indexes, [('testmodelindex_intTest_idx', ['intTest'], False),
+                                   ('testmodelindex_varcharTest_idx', ['varcharTest'], True),
+                                   ('int_varchar', ['intTest', 'varcharTest'], False)])
+        self.assertEqual(self.TestModel._indexes, [])
+        with self.assertRaises(bc.Error):
+            class TestModelBadIndex(basium_model.Model):
+                _indexes = [basium_model.Index('notAColumn')]
+        with self.assertRaises(bc.Error):
+            class TestModelLongName(basium_model.Model):
+                intTest = basium_model.IntegerCol()
+                _indexes = [basium_model.Index('intTest', name='x' * 64)]
+
+        class TestModelLongColumns(basium_model.Model):
+            aVeryLongColumnNameForTestingIndexNames = basium_model.IntegerCol()
+            anotherVeryLongColumnNameForTestingIndexNames = basium_model.IntegerCol()
+            _indexes = [basium_model.Index('aVeryLongColumnNameForTestingIndexNames', 'anotherVeryLongColumnNameForTestingIndexNames'),
+                        basium_model.Index('anotherVeryLongColumnNameForTestingIndexNames', 'aVeryLongColumnNameForTestingIndexNames')]
+        names = [index.name for index in TestModelLongColumns._indexes]
+        self.assertEqual([len(name) for name in names], [63, 63])
+        self.assertNotEqual(names[0], names[1])
+
+
+class TestPool(unittest.TestCase):
+    """
+    Test the ConnectionPool, with dummy connections
+    """
+
+    class Conn:
+        def __init__(self):
+            self.alive = True
+            self.closed = False
+
+    def newPool(self, **kwargs):
+        self.conns = []
+
+        def connect():
+            conn = self.Conn()
+            self.conns.append(conn)
+            return conn
+
+        def close(conn):
+            conn.closed = True
+
+        return basium_driver.ConnectionPool(connect, close=close, ping=lambda conn: conn.alive, **kwargs)
+
+    def testReuse(self):
+        pool = self.newPool(maxsize=2, timeout=0.05)
+        conn1 = pool.checkout()
+        conn2 = pool.checkout()
+        self.assertIsNot(conn1, conn2)
+        self.assertRaises(bc.Error, pool.checkout)
+        pool.checkin(conn1)
+        self.assertIs(pool.checkout(), conn1)
+        stats = pool.stats()
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["inuse"], 2)
+        self.assertEqual(stats["utilization"], 1.0)
+        self.assertEqual(stats["timeouts"], 1)
+
+    def testWait(self):
+        pool = self.newPool(maxsize=1, timeout=5)
+        conn = pool.checkout()
+        timer = threading.Timer(0.05, pool.checkin, (conn,))
+        timer.start()
+        self.assertIs(pool.checkout(), conn)
+        timer.join()
+        stats = pool.stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertGreater(stats["maxwait"], 0)
+
+    def testExpire(self):
+        pool = self.newPool(maxsize=2, check=0, lifetime=3600)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        conn.alive = False      # fails the health check
+        conn2 = pool.checkout()
+        self.assertIsNot(conn2, conn)
+        self.assertTrue(conn.closed)
+        pool.checkin(conn2, broken=True)
+        self.assertTrue(conn2.closed)
+
+        pool = self.newPool(maxsize=2, lifetime=0)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()["size"], 0)
+
+
+class TestStandalone(unittest.TestCase):
+    """
+    Tests that runs in a new python process, so they only see the
+    modules basium itself imports
+    """
+
+    def run_python(self, code):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+        result = subprocess.run([sys.executable, "-c", code], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        self.assertEqual(result.returncode, 0, msg=result.stdout)
+
+    def testCache(self):
+        self.run_python("""
+import sys
+import decimal
+import datetime
+import logging
+import basium
+import basium_orm
+import test_tables
+db = basium.Basium(driver='sqlite', dbconf=basium.DbConf(database=':memory:'), checkTables=True)
+db.log.logger.setLevel(logging.ERROR)
+db.addClass(test_tables.BasiumTest)
+assert db.start()
+cache = basium_orm.QueryCache(maxsize=10, ttl=60)
+db.setCache(cache)
+obj = test_tables.BasiumTest()
+obj.booleanTest = True
+obj.dateTest = datetime.date(2013, 1, 2)
+obj.datetimeTest = datetime.datetime(2013, 1, 2, 3, 4, 5)
+obj.decimalTest = decimal.Decimal('1.23')
+obj.floatTest = 1.5
+obj.intTest = 1
+obj.varcharTest = 'cache'
+db.store(obj)
+query = db.query().filter(obj.q.intTest, '=', 1)
+assert len(db.load(query)) == 1
+assert db.count(query) == 1
+assert db.exists(query)
+assert len(db.load(query)) == 1
+assert cache.hits == 1, cache.hits
+assert 'wsgi' not in sys.modules
+""")
+
+
+class TestQuery(unittest.TestCase):
+    """
+    Test the Query class, without a database
+    """
+
+    def encodeDecode(self, query):
+        """Encode the query, decode it in a new query and compare"""
+        obj = test_tables.BasiumTest()
+        query2 = basium_orm.Query(obj, log=log)
+        query2.decode(query.encode())
+        self.assertEqual(query2.encode(), query.encode())
+        self.assertEqual(query2.shape(), query.shape())
+        return query2
+
+    def testSqlCache(self):
+        cache = basium_driver.SqlCache(maxsize=2)
+        cache['a'] = 'sql a'
+        cache['b'] = 'sql b'
+        self.assertEqual(cache.get('a'), 'sql a')  # b is now the least recently used
+        cache['c'] = 'sql c'
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertRaises(KeyError, cache.__getitem__, 'b')
+        self.assertEqual(cache['c'], 'sql c')
+
+    def testEncode(self):
+        obj = test_tables.BasiumTest()
+        query = basium_orm.Query(obj, log=log)
+        query.filter(obj.q.intTest, '>', 5).order(obj.q.varcharTest, desc=True).limit(10, 20)
+        self.encodeDecode(query)
+
+    def testOnlyValues(self):
+        obj = test_tables.BasiumTest()
+        query = basium_orm.Query(obj, log=log).only(obj.q.intTest, obj.q.varcharTest)
+        query2 = self.encodeDecode(query)
+        self.assertEqual(query2.columnNames(), ['_id', 'intTest', 'varcharTest'])
+
+        query = basium_orm.Query(obj, log=log).values(obj.q.intTest, asdict=True)
+        query2 = self.encodeDecode(query)
+        self.assertEqual(query2._rowtype, 'dict')
+
+    def testKeyset(self):
+        obj = test_tables.BasiumTest()
+        obj._values['intTest'] = 42
+        obj._values['_id'] = 7
+        query = basium_orm.Query(obj, log=log).order(obj.q.intTest).after(obj)
+        self.assertEqual(query._after, [42, 7])
+        query2 = self.encodeDecode(query)
+        self.assertEqual(query2._after, [42, 7])
+
+        query = basium_orm.Query(obj, log=log).order(obj.q.intTest)
+        query2 = basium_orm.Query(obj, log=log).order(obj.q.intTest).after(query.token(obj))
+        self.assertEqual(query2._after, [42, 7])
+
+    def testKeysetTypes(self):
+        """
+        The keyset values must keep their type through a token and the URL
+        """
+        obj = test_tables.BasiumTest()
+        obj._values['booleanTest'] = False
+        obj._values['dateTest'] = datetime.date(2013, 1, 2)
+        obj._values['datetimeTest'] = datetime.datetime(2013, 1, 2, 3, 4, 5)
+        obj._values['decimalTest'] = decimal.Decimal('1.25')
+        obj._values['floatTest'] = 2.5
+        obj._values['_id'] = 7
+        expected = [False, datetime.date(2013, 1, 2), datetime.datetime(2013, 1, 2, 3, 4, 5), decimal.Decimal('1.25'), 2.5, 7]
+
+        def newQuery():
+            return basium_orm.Query(obj, log=log).order(obj.q.booleanTest).order(obj.q.dateTest) \
+                .order(obj.q.datetimeTest).order(obj.q.decimalTest).order(obj.q.floatTest)
+
+        query = newQuery().after(newQuery().token(obj))
+        self.assertEqual(query._after, expected)
+        self.assertEqual([type(v) for v in query._after], [type(v) for v in expected])
+        self.assertEqual(self.encodeDecode(query)._after, expected)
+
+    def testKeysetJoin(self):
+        """
+        Keyset pagination on a column in a joined table is not supported
+        """
+        ref = test_tables.BasiumTestRef()
+        query = basium_orm.Query(ref, log=log).join(ref.q.parent).order(test_tables.BasiumTest.q.intTest)
+        self.assertRaises(bc.Error, query.token, ref)
+        self.assertRaises(bc.Error, query.after, ref)
+
+    def testAggregate(self):
+        obj = test_tables.BasiumTest()
+        query = basium_orm.Query(obj, log=log).filter(obj.q.intTest, '>', 5).group(obj.q.varcharTest)
+        query.aggregate(n=basium_orm.Count(), total=basium_orm.Sum(obj.q.intTest))
+        query2 = self.encodeDecode(query)
+        self.assertEqual(query2.columnNames(), ['varcharTest', 'n', 'total'])
+        self.assertEqual(query2.selectSql(), 'varcharTest,COUNT(*) AS n,SUM(intTest) AS total')
+
+    def testSplit(self):
+        obj = test_tables.BasiumTest()
+        query = basium_orm.Query(obj, log=log).filter(obj.q.intTest, basium_orm.NOT_IN, [1, 2])
+        self.assertEqual(self.encodeDecode(query)._where[0].value, ['1', '2'])
+
+        query = basium_orm.Query(obj, log=log).filter(obj.q.varcharTest, '=', 'x')
+        query.filter(obj.q._id, basium_orm.IN, [1, 2, 3, 2, 4, 5, 6])
+        self.assertEqual([q._where[1].value for q in query.split(3)], [[1, 2], [3, 4], [5, 6]])
+        self.assertEqual(query.split(None), [query])
+        self.assertRaises(bc.Error, query.limit(rowcount=5).split, 3)
+
+    def testInShape(self):
+        """
+        IN lists are padded to a power of two, so lists of similar
+        length shares the compiled SQL
+        """
+        obj = test_tables.BasiumTest()
+        shapes = set()
+        for n in range(5, 9):
+            query = basium_orm.Query(obj, log=log).filter(obj.q._id, basium_orm.IN, list(range(n)))
+            shapes.add(query.shape())
+            self.assertEqual(query._where[0].condition().count('%s'), 8)
+            self.assertEqual(query.paramCount(), 8)
+        self.assertEqual(len(shapes), 1)
+
+    def testExpression(self):
+        obj = test_tables.BasiumTest()
+        Q = basium_orm.Q
+        expr = Q(obj.q.intTest, '=', 1) | Q(obj.q.varcharTest, '!=', 'a,b') & ~Q(obj.q._id, basium_orm.IN, [3, 4])
+        query = basium_orm.Query(obj, log=log).filter(expr)
+        self.assertEqual(query._compileSql(),
+                         ' where ((intTest = %s OR (varcharTest != %s AND NOT (_id IN (%s,%s)))))')
+        query2 = self.encodeDecode(query)
+        self.assertEqual(query2._where[0].wheres()[1].value, 'a,b')
+        self.assertEqual(query2.paramCount(), 4)
+
+    def testJoin(self):
+        obj = test_tables.BasiumTest()
+        ref = test_tables.BasiumTestRef()
+        query = basium_orm.Query(ref, log=log).join(ref.q.parent).filter(obj.q.intTest, 'IN', [1, 2])
+        query.order(obj.q.varcharTest)
+        query2 = basium_orm.Query(ref, log=log)
+        query2.decode(query.encode())
+        self.assertEqual(query2.encode(), query.encode())
+        self.assertEqual(query2.shape(), query.shape())
+        self.assertEqual(query2._where[0].value, ['1', '2'])
+        self.assertIn('parent__intTest', query2.columnNames())
+
 
 def get_suite():
     """
@@ -348,6 +1328,9 @@ def get_suite():
     testloader = unittest.TestLoader()
 
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestModel))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestQuery))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestPool))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestStandalone))
 
     for driver in drivers:
         testnames = testloader.getTestCaseNames(TestFunctions)
@@ -373,6 +1356,7 @@ def runServer():
     db.setDebug(bc.DEBUG_ALL)
     db.log.logger.setLevel(logging.ERROR)
     db.addClass(test_tables.BasiumTest)
+    db.addClass(test_tables.BasiumTestRef)
     if not db.start():
         log.error("Cannot start database driver for wsgi server")
 
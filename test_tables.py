@@ -41,3 +41,9 @@ class BasiumTest(basium_model.Model):
     floatTest = basium_model.FloatCol()
     intTest = basium_model.IntegerCol()
     varcharTest = basium_model.VarcharCol()
+
+
+class BasiumTestRef(basium_model.Model):
+    parent = basium_model.ReferenceCol(BasiumTest)
+    name = basium_model.VarcharCol(index=True)
+    _indexes = [basium_model.Index('parent', 'name')]
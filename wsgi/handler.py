@@ -241,8 +241,14 @@ class AppServer:
         log.debug("basium_wsgihandler.__call__(), PATH_INFO %s" %
                   environ["PATH_INFO"])
 
-        if not self.handleRequest(environ):
-            self.handleError()
+        try:
+            if not self.handleRequest(environ):
+                self.handleError()
+        finally:
+            # objects in the identity map are only valid during one request
+            db = self.app.db
+            if db is not None and db.session is not None:
+                db.session.clear()
 
         self.response.content_type += "; charset=utf-8"
         self.response.addHeader('Content-type', self.response.content_type)
@@ -332,6 +338,7 @@ if __name__ == "__main__":
     app.db = basium.Basium(driver=args.dbdriver, dbconf=app.dbconf, checkTables=True)
     app.db.setDebug(bc.DEBUG_ALL)
     app.db.addClass(test_tables.BasiumTest)
+    app.db.addClass(test_tables.BasiumTestRef)
     if not app.db.start():
         log.error("Cannot start database driver for wsgi server")
 